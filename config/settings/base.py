@@ -2,6 +2,9 @@
 Base settings
 """
 
+import multiprocessing
+import tempfile
+
 import environ
 
 ROOT_DIR = environ.Path(__file__) - 3 # Repo root
@@ -110,4 +113,50 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
-CRISPY_CLASS_CONVERTERS = {'form-check': 'div1', 'form-check-label': 'labl1', 'form-check-input': 'i1'}
\ No newline at end of file
+CRISPY_CLASS_CONVERTERS = {'form-check': 'div1', 'form-check-label': 'labl1', 'form-check-input': 'i1'}
+
+# Linter
+# Compile schemas and caches in AppConfig.ready() (i.e. in the gunicorn master with preload_app)
+LINTER_PRELOAD = env.bool("LINTER_PRELOAD", default=False)
+
+# Lint each upload in a pre-forked, resource-limited worker process (see linter/sandbox.py).
+# Uploads that hit a limit get a "document too complex" page instead of pinning the web worker.
+LINTER_SANDBOX = {
+    'size': 1,            # sandbox processes per web worker
+    'cpu_seconds': 10,    # RLIMIT_CPU per lint
+    'memory_mb': 512,     # RLIMIT_AS headroom above the forked worker's size
+    'timeout': 15,        # wall-clock seconds before the lint is killed
+    'max_jobs': 100,      # recycle a sandbox process after this many lints
+    'max_rss_mb': 300,    # ...or once its peak RSS crosses this
+} if env.bool("LINTER_SANDBOX", default=False) else None
+
+# Send lints to a long-lived `manage.py lint_server` daemon (see linter/daemon.py) that keeps warm
+# caches and a pool of sandbox workers. If it isn't running, lints run in the web worker as before.
+LINTER_DAEMON = {
+    'socket_path': env("LINTER_DAEMON_SOCKET", default=tempfile.gettempdir() + '/springcm-tools-lint.sock'),
+    'workers': multiprocessing.cpu_count(),  # sandbox workers in the daemon
+    'connect_timeout': 0.5,  # seconds to wait for the daemon before linting in-process
+    'queue_wait': 10,        # seconds a lint waits for a free worker before the upload gets a 503
+    'timeout': 30,           # seconds to wait for a result, more than queue_wait plus the sandbox timeout
+} if env.bool("LINTER_DAEMON", default=False) else None
+
+# Admission control for lints (see linter/admission.py). Slots are shared by every
+# process through lock files in lock_dir. When saturated, uploads get a fast 503 with Retry-After.
+LINTER_ADMISSION = {
+    'lock_dir': env("LINTER_ADMISSION_DIR", default=tempfile.gettempdir() + '/springcm-tools-admission'),
+    'max_concurrent': multiprocessing.cpu_count(),  # lints running at once, across all workers
+    'per_process': None,  # lints at once per worker process, defaults to max_concurrent
+    'per_client': 1,      # lints at once per client address
+    'queue': 8,           # uploads allowed to wait for a slot
+    'wait': 5.0,          # seconds a queued upload waits before giving up
+    'retry_after': 10,    # Retry-After seconds sent with the 503
+} if env.bool("LINTER_ADMISSION", default=False) else None
+
+# Opt-in cProfile capture of lints (see linter/profiling.py). When enabled, staff can profile an upload
+# by adding ?profile to the index URL; otherwise a sample_rate fraction of lints is profiled.
+LINTER_PROFILE = {
+    'sample_rate': env.float("LINTER_PROFILE_SAMPLE_RATE", default=0.0),
+    'dir': env("LINTER_PROFILE_DIR", default=str(ROOT_DIR.path("profiles"))),
+    'keep': 200,  # profiles kept on disk, oldest are deleted first
+    'show': 25,   # slowest profiles listed at /profiles/
+} if env.bool("LINTER_PROFILE", default=False) else None
\ No newline at end of file
@@ -8,4 +8,4 @@ ALLOWED_HOSTS = ["localhost", "127.0.0.1", "0.0.0.0"]
 INSTALLED_APPS = ['debug_toolbar'] + INSTALLED_APPS
 MIDDLEWARE = ['debug_toolbar.middleware.DebugToolbarMiddleware'] + MIDDLEWARE
 INTERNAL_IPS = ['127.0.0.1']
-UPLOAD_DIR = str(ROOT_DIR.path("uploads"))
\ No newline at end of file
+UPLOAD_DIR = env("DJANGO_UPLOAD_DIR", default=str(ROOT_DIR.path("uploads")))
\ No newline at end of file
@@ -5,4 +5,12 @@ DEBUG = False
 SECRET_KEY = env('DJANGO_SECRET_KEY')
 ALLOWED_HOSTS = ["localhost", "127.0.0.1", "0.0.0.0", "springcm.khanna.cc"]
 STATIC_ROOT = str(ROOT_DIR.path("static"))
-UPLOAD_DIR = str(ROOT_DIR.path("uploads"))
\ No newline at end of file
+# Hashed filenames with precompressed .gz/.br copies, served by nginx with far-future caching
+STATICFILES_STORAGE = 'springcm_tools.linter.storage.CompressedManifestStaticFilesStorage'
+INSTALLED_APPS = [
+    'springcm_tools.linter.apps.LinterStaticFilesConfig' if app == 'django.contrib.staticfiles' else app
+    for app in INSTALLED_APPS
+]
+LINTER_PURGE_CSS = env.bool("LINTER_PURGE_CSS", default=False)
+UPLOAD_DIR = env("DJANGO_UPLOAD_DIR", default=str(ROOT_DIR.path("uploads")))
+LINTER_PRELOAD = env.bool("LINTER_PRELOAD", default=True)
\ No newline at end of file
@@ -0,0 +1,253 @@
+"""
+Admission control for lints.
+
+Capacity is a set of slot files in a shared directory. Holding an flock on a
+slot file is holding the slot, so the limits apply across all gunicorn workers
+and a crashed worker's slots are released by the kernel.
+
+Queued requests line up by ticket number in line.json, so a free slot goes to
+the request that has waited longest, not to whichever polls first.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.shortcuts import render
+
+POLL_INTERVAL = 0.05
+
+class Saturated(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class Slot:
+    def __init__(self, fd, path):
+        self.fd = fd
+        self.path = path
+
+    def release(self, remove=False):
+        # Remove while still locked, so anyone who opened the file before it went
+        # sees that it's gone once they get the lock (see open_slot)
+        if remove:
+            os.remove(self.path)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+def flocked_files():
+    """
+    (device, inode) of every file with an flock held on it, from /proc/locks.
+    Lets stats() see which slots are taken without taking them itself. None if
+    /proc/locks isn't available.
+    """
+    try:
+        with open('/proc/locks') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    held = set()
+    for line in lines:
+        fields = line.split()
+        # Blocked waiters are listed with '->' and don't hold the lock
+        if len(fields) < 6 or fields[1] != 'FLOCK':
+            continue
+        major, minor, inode = fields[5].split(':')
+        held.add((os.makedev(int(major, 16), int(minor, 16)), int(inode)))
+    return held
+
+class AdmissionController:
+    def __init__(self, lock_dir, max_concurrent=2, per_process=None, per_client=1, queue=8, wait=5.0, retry_after=10):
+        self.lock_dir = lock_dir
+        self.max_concurrent = max_concurrent
+        self.per_client = per_client
+        self.queue = queue
+        self.wait = wait
+        self.retry_after = retry_after
+        self.semaphore = threading.BoundedSemaphore(per_process or max_concurrent)
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def slot_path(self, name):
+        return os.path.join(self.lock_dir, name + '.lock')
+
+    def open_slot(self, name):
+        path = self.slot_path(name)
+        while True:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # Client slots are removed on release. If that happened between our open
+            # and flock, we locked a file nobody else will see, so start over.
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return Slot(fd, path)
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def try_slot(self, prefix, count):
+        """Take the first free slot named prefix-0..count-1, or return None."""
+        for index in range(count):
+            slot = self.open_slot(f'{prefix}-{index}')
+            if slot:
+                return slot
+        return None
+
+    def slots_held(self, prefix, count, flocked):
+        """How many of the slots are taken, or None if that can't be told without taking them."""
+        if flocked is None:
+            return None
+        held = 0
+        for index in range(count):
+            try:
+                stat = os.stat(self.slot_path(f'{prefix}-{index}'))
+            except FileNotFoundError:
+                continue
+            held += (stat.st_dev, stat.st_ino) in flocked
+        return held
+
+    @contextmanager
+    def admit(self, client):
+        """Hold a lint slot for the duration of the block, or raise Saturated."""
+        # Fairness: a client already using its share is turned away without queueing,
+        # so bulk uploads from one client can't fill the queue for everyone else.
+        client_key = hashlib.sha1(client.encode()).hexdigest()[:16]
+        client_slot = self.try_slot(f'client-{client_key}', self.per_client)
+        if not client_slot:
+            self.reject('client')
+
+        have_semaphore = False
+        slot = None
+        queue_slot = None
+        ticket = None
+        try:
+            deadline = time.monotonic() + self.wait
+            while True:
+                if not have_semaphore:
+                    have_semaphore = self.semaphore.acquire(blocking=False)
+                if have_semaphore:
+                    ticket, first = self.line_up(ticket)
+                    if first:
+                        slot = self.try_slot('lint', self.max_concurrent)
+                        if slot:
+                            self.leave_line(ticket)
+                            ticket = None
+                            break
+                # No capacity right now, so wait in the queue if there's room in it
+                if not queue_slot:
+                    queue_slot = self.try_slot('queue', self.queue)
+                    if not queue_slot:
+                        self.reject('queue_full')
+                if time.monotonic() >= deadline:
+                    self.reject('timeout')
+                time.sleep(POLL_INTERVAL)
+
+            if queue_slot:
+                queue_slot.release()
+                queue_slot = None
+            yield
+        finally:
+            if ticket is not None:
+                self.leave_line(ticket)
+            if have_semaphore:
+                self.semaphore.release()
+            for held in (slot, queue_slot):
+                if held:
+                    held.release()
+            # One file per client address would pile up, so client slots are removed
+            client_slot.release(remove=True)
+
+    def reject(self, reason):
+        self.count_rejection(reason)
+        raise Saturated(reason, self.retry_after)
+
+    def line_up(self, ticket=None):
+        """
+        Join the line (when ticket is None) or check on ticket. Returns the ticket and
+        whether it's first in line. A ticket expires shortly after its wait runs out, so
+        one left behind by a crashed worker doesn't hold up the line.
+        """
+        now = time.time()
+        with self.locked_json('line.json') as line:
+            waiting = [entry for entry in line.get('waiting', []) if entry[1] > now]
+            if ticket is None:
+                ticket = line.get('next', 0)
+                line['next'] = ticket + 1
+                waiting.append([ticket, now + self.wait + 1])
+            line['waiting'] = waiting
+            return ticket, waiting[0][0] == ticket
+
+    def leave_line(self, ticket):
+        with self.locked_json('line.json') as line:
+            line['waiting'] = [entry for entry in line.get('waiting', []) if entry[0] != ticket]
+
+    @contextmanager
+    def locked_json(self, name):
+        with open(os.path.join(self.lock_dir, name), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                data = json.loads(f.read() or '{}')
+            except ValueError:
+                data = {}
+            yield data
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(data))
+
+    def count_rejection(self, reason):
+        with self.locked_json('stats.json') as stats:
+            stats[reason] = stats.get(reason, 0) + 1
+
+    def stats(self):
+        with self.locked_json('stats.json') as rejected:
+            pass
+        flocked = flocked_files()
+        return {
+            'in_flight': self.slots_held('lint', self.max_concurrent, flocked),
+            'max_concurrent': self.max_concurrent,
+            'queue_depth': self.slots_held('queue', self.queue, flocked),
+            'queue_size': self.queue,
+            'rejected': rejected,
+        }
+
+_controller = None
+_controller_lock = threading.Lock()
+
+def get_controller():
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(**settings.LINTER_ADMISSION)
+        return _controller
+
+def admission_control(view):
+    """Run view only once a lint slot is free, otherwise respond 503 with Retry-After."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.LINTER_ADMISSION:
+            return view(request, *args, **kwargs)
+        try:
+            with get_controller().admit(client_address(request)):
+                return view(request, *args, **kwargs)
+        except Saturated as e:
+            return busy_response(request, e.reason, e.retry_after)
+    return wrapper
+
+def busy_response(request, reason, retry_after):
+    response = render(request, 'linter/busy.html', {'reason': reason}, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+def client_address(request):
+    # nginx passes the real client address in X-Real-IP
+    return request.META.get('HTTP_X_REAL_IP') or request.META.get('REMOTE_ADDR', '')
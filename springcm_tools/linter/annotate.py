@@ -0,0 +1,164 @@
+"""
+Write a copy of a .docx with a Word comment at each lint error.
+
+Only the main document part, its relationships, [Content_Types].xml and
+the comments part are rewritten. Every other part, e.g. images, is copied
+across as raw compressed bytes without being inflated and deflated again.
+"""
+import copy
+import posixpath
+import struct
+import zipfile
+from collections import defaultdict
+from datetime import datetime
+
+from lxml import etree as ET
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+PACKAGE_RELS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+CONTENT_TYPES = 'http://schemas.openxmlformats.org/package/2006/content-types'
+OFFICE_DOCUMENT_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+COMMENTS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/comments'
+COMMENTS_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.comments+xml'
+
+AUTHOR = 'SpringCM Template Checker'
+INITIALS = 'STC'
+
+# Local file header: signature, versions, flags, method, time, date, crc, sizes, name/extra lengths
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+def w(tag):
+    return f'{{{W}}}{tag}'
+
+def serialize(root):
+    return ET.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+def rels_name(part_name):
+    directory, filename = posixpath.split(part_name)
+    return posixpath.join(directory, '_rels', filename + '.rels')
+
+def main_part_name(zin):
+    rels = ET.fromstring(zin.read('_rels/.rels'))
+    for rel in rels.iter(f'{{{PACKAGE_RELS}}}Relationship'):
+        if rel.get('Type') == OFFICE_DOCUMENT_REL:
+            return rel.get('Target').lstrip('/')
+    return 'word/document.xml'
+
+def comments_part_name(rels, document_name):
+    """The part name of the comments related to document_name, or None if it has none."""
+    for rel in rels.iter(f'{{{PACKAGE_RELS}}}Relationship'):
+        if rel.get('Type') == COMMENTS_REL and rel.get('TargetMode') != 'External':
+            target = rel.get('Target')
+            if target.startswith('/'):
+                return target.lstrip('/')
+            return posixpath.normpath(posixpath.join(posixpath.dirname(document_name), target))
+    return None
+
+def copy_raw(source, zout, info):
+    """Append info's member from source to zout without recompressing it."""
+    source.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(source.read(LOCAL_HEADER.size))
+    source.seek(info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1])
+
+    zinfo = copy.copy(info)
+    # Sizes and CRC go in the header we write, so no trailing data descriptor
+    zinfo.flag_bits &= ~0x08
+    zinfo.header_offset = zout.fp.tell()
+    zout.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.read(min(remaining, 1024 * 1024))
+        zout.fp.write(chunk)
+        remaining -= len(chunk)
+
+    # zipfile has no public API for raw copies, so register the member the way ZipFile.write does
+    zout.filelist.append(zinfo)
+    zout.NameToInfo[zinfo.filename] = zinfo
+    zout.start_dir = zout.fp.tell()
+
+def add_comments(document, comments, errors):
+    """Anchor a comment for each error on its paragraph. Returns the number of comments added."""
+    existing = [int(comment.get(w('id'))) for comment in comments.iter(w('comment'))]
+    next_id = max(existing, default=-1) + 1
+    date = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    by_paragraph = defaultdict(list)
+    for error in errors:
+        by_paragraph[error['paragraph']].append(error)
+
+    paragraphs = document.find(w('body')).findall(w('p'))
+    added = 0
+    for paragraph_number, paragraph_errors in sorted(by_paragraph.items()):
+        p = paragraphs[paragraph_number]
+        # Ranges start after the paragraph properties, which must stay the first child
+        start = 1 if len(p) and p[0].tag == w('pPr') else 0
+        for error in paragraph_errors:
+            comment_id = str(next_id)
+            next_id += 1
+            added += 1
+
+            p.insert(start, ET.Element(w('commentRangeStart'), {w('id'): comment_id}))
+            ET.SubElement(p, w('commentRangeEnd'), {w('id'): comment_id})
+            ET.SubElement(ET.SubElement(p, w('r')), w('commentReference'), {w('id'): comment_id})
+
+            comment = ET.SubElement(comments, w('comment'), {w('id'): comment_id, w('author'): AUTHOR, w('date'): date, w('initials'): INITIALS})
+            for text in (error['error'], error['directive_string']):
+                if text:
+                    t = ET.SubElement(ET.SubElement(ET.SubElement(comment, w('p')), w('r')), w('t'))
+                    t.text = text
+                    t.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+    return added
+
+def annotate(src_path, dest, errors, document=None):
+    """
+    Write src_path to dest (a path or seekable binary file) with a comment at each of
+    errors (as serialized by utils.serialize_errors). If the w:document
+    element has already been parsed, e.g. by python-docx, pass it as document
+    to skip parsing it again.
+    """
+    with zipfile.ZipFile(src_path) as zin, open(src_path, 'rb') as source:
+        document_name = main_part_name(zin)
+        document_rels_name = rels_name(document_name)
+        names = set(zin.namelist())
+        if document_rels_name in names:
+            rels = ET.fromstring(zin.read(document_rels_name))
+        else:
+            rels = ET.Element(f'{{{PACKAGE_RELS}}}Relationships', nsmap={None: PACKAGE_RELS})
+        # Word names it comments.xml, but other producers may not, so follow the relationship
+        comments_name = comments_part_name(rels, document_name)
+        has_comments = comments_name in names
+        if not has_comments:
+            directory = posixpath.dirname(document_name)
+            comments_name = next(
+                name for name in (posixpath.join(directory, f'comments{n or ""}.xml') for n in range(len(names) + 1))
+                if name not in names
+            )
+
+        if document is None:
+            document = ET.fromstring(zin.read(document_name))
+        if has_comments:
+            comments = ET.fromstring(zin.read(comments_name))
+        else:
+            comments = ET.Element(w('comments'), nsmap={'w': W})
+        add_comments(document, comments, errors)
+
+        rewritten = {document_name: serialize(document), comments_name: serialize(comments)}
+        if not has_comments:
+            content_types = ET.fromstring(zin.read('[Content_Types].xml'))
+            ET.SubElement(content_types, f'{{{CONTENT_TYPES}}}Override', PartName='/' + comments_name, ContentType=COMMENTS_CONTENT_TYPE)
+            rewritten['[Content_Types].xml'] = serialize(content_types)
+
+            ids = {rel.get('Id') for rel in rels}
+            rel_id = next(f'rIdLint{n}' for n in range(1, len(ids) + 2) if f'rIdLint{n}' not in ids)
+            ET.SubElement(rels, f'{{{PACKAGE_RELS}}}Relationship', Id=rel_id, Type=COMMENTS_REL, Target=posixpath.basename(comments_name))
+            rewritten[document_rels_name] = serialize(rels)
+
+        with zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                if info.filename in rewritten:
+                    zout.writestr(info.filename, rewritten.pop(info.filename))
+                else:
+                    copy_raw(source, zout, info)
+            # Parts that didn't exist before
+            for name, data in rewritten.items():
+                zout.writestr(name, data)
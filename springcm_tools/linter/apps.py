@@ -1,5 +1,19 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.contrib.staticfiles.apps import StaticFilesConfig
 
 
 class LinterConfig(AppConfig):
     name = 'springcm_tools.linter'
+
+    def ready(self):
+        # With gunicorn's preload_app this runs once in the master, so the
+        # compiled schema is shared copy-on-write by every worker.
+        if getattr(settings, 'LINTER_PRELOAD', False):
+            from . import utils
+            utils.warm()
+
+
+class LinterStaticFilesConfig(StaticFilesConfig):
+    """collectstatic without the RTL theme and source maps, which production doesn't serve."""
+    ignore_patterns = StaticFilesConfig.ignore_patterns + ['*.map', '*-rtl.css', '*-rtl.min.css']
@@ -0,0 +1,89 @@
+"""
+Drop CSS rules whose selectors use class names that appear nowhere in the site.
+
+This is deliberately conservative: a class counts as used if its name shows up
+as a token anywhere in the templates or JavaScript, and anything it doesn't
+understand (at-rules other than @media/@supports, keyframes, fonts) is kept as is.
+"""
+import re
+
+COMMENT = re.compile(r'/\*.*?\*/', re.S)
+TOKEN = re.compile(r'[A-Za-z_][\w-]*')
+CLASS = re.compile(r'\.(-?[_a-zA-Z][\w-]*)')
+# Classes inside :not(...) etc. don't have to be present for the selector to match
+PSEUDO_ARGS = re.compile(r':[\w-]+\([^)]*\)')
+NESTED_AT_RULES = ('@media', '@supports', '@document')
+
+def used_tokens(texts):
+    tokens = set()
+    for text in texts:
+        tokens.update(TOKEN.findall(text))
+    return tokens
+
+def matching_brace(css, start):
+    """Index of the } closing the { at start, skipping strings."""
+    depth = 0
+    quote = None
+    for index in range(start, len(css)):
+        char = css[index]
+        if quote:
+            if char == '\\':
+                continue
+            if char == quote and css[index - 1] != '\\':
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return index
+    return len(css) - 1
+
+def keep_selector(selector, used):
+    return all(name in used for name in CLASS.findall(PSEUDO_ARGS.sub('', selector)))
+
+def purge_rules(css, used):
+    result = []
+    pos = 0
+    while pos < len(css):
+        brace = css.find('{', pos)
+        if brace == -1:
+            result.append(css[pos:])
+            break
+
+        prelude = css[pos:brace]
+        semicolon = prelude.rfind(';')
+        if semicolon != -1:
+            # Statements like @charset or @import before the next block
+            result.append(prelude[:semicolon + 1])
+            prelude = prelude[semicolon + 1:]
+
+        end = matching_brace(css, brace)
+        body = css[brace + 1:end]
+        head = prelude.strip()
+
+        if head.startswith(NESTED_AT_RULES):
+            inner = purge_rules(body, used)
+            if inner.strip():
+                result.append(f'{head}{{{inner}}}')
+        elif head.startswith('@'):
+            result.append(f'{head}{{{body}}}')
+        else:
+            selectors = [selector.strip() for selector in head.split(',') if keep_selector(selector, used)]
+            if selectors:
+                result.append(f"{','.join(selectors)}{{{body}}}")
+        pos = end + 1
+    return ''.join(result)
+
+def purge_css(css, used):
+    # Keep /*! license */ comments, drop the rest
+    licenses = [comment for comment in COMMENT.findall(css) if comment.startswith('/*!')]
+    purged = purge_rules(COMMENT.sub('', css), used).strip()
+    # @charset has to stay the very first thing in the file
+    charset = []
+    if purged.startswith('@charset'):
+        statement, purged = purged.split(';', 1)
+        charset = [statement + ';']
+    return '\n'.join(charset + licenses + [purged])
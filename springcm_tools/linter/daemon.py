@@ -0,0 +1,174 @@
+"""
+A long-lived lint daemon (manage.py lint_server) and its client.
+
+The daemon warms the linter once and keeps a pool of sandbox workers whose
+schema, XPath and tag validation caches stay warm between jobs. Clients talk
+to it over a Unix domain socket. Each message is a 4-byte big-endian length
+followed by that many bytes of JSON. Requests carry the path of a file that is
+already on disk, never the document itself:
+
+    {"path": "/abs/path/upload.docx", "options": {...}}  ->  {"status": "ok", "payload": report}
+
+options are passed through to utils.lint_path, and status/payload are as
+returned by a sandbox worker (see sandbox.unpack_result).
+"""
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from django.conf import settings
+
+from .sandbox import DocumentTooComplex, SandboxBusy, SandboxPool, unpack_result
+from .utils import BadDocument, warm
+
+HEADER = struct.Struct('>I')
+# Reports for huge documents are big, but anything past this is a corrupt stream
+MAX_MESSAGE = 64 * 1024 * 1024
+
+class DaemonUnavailable(Exception):
+    """The daemon isn't running or went away, so lint in-process instead."""
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_message(sock):
+    size, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if size > MAX_MESSAGE:
+        raise ValueError(f'Message of {size} bytes is too large')
+    return json.loads(recv_exactly(sock, size).decode('utf-8'))
+
+class LintHandler(socketserver.BaseRequestHandler):
+    """Serves lint requests on one connection until the client hangs up."""
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (EOFError, OSError, ValueError):
+                return
+            try:
+                result = ('ok', self.server.pool.lint(request['path'], **request['options']))
+            except BadDocument as e:
+                result = ('bad_document', str(e))
+            except DocumentTooComplex as e:
+                result = ('too_complex', str(e))
+            except SandboxBusy as e:
+                result = ('busy', str(e))
+            except Exception as e:
+                result = ('error', repr(e))
+            try:
+                send_message(self.request, {'status': result[0], 'payload': result[1]})
+            except OSError:
+                # The client gave up waiting
+                return
+
+class LintServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers, queue_wait=None):
+        self.socket_path = socket_path
+        remove_stale_socket(socket_path)
+        # Warm before the pool forks so the initial workers inherit the compiled schema. Replacements
+        # are forked from handler threads, whose thread-local validator is empty, and warm up themselves.
+        warm()
+        # Jobs that can't get a worker in time are answered 'busy', before the client gives up on them
+        limits = dict(settings.LINTER_SANDBOX or {}, size=workers, queue_wait=queue_wait)
+        self.pool = SandboxPool(**limits)
+        super().__init__(socket_path, LintHandler)
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+def remove_stale_socket(socket_path):
+    """Remove a socket left behind by a daemon that died. Raises OSError if one is still listening."""
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+    else:
+        raise OSError(f'A lint server is already listening on {socket_path}')
+    finally:
+        sock.close()
+
+class LintClient:
+    """Sends lints to the daemon, keeping one connection open per thread."""
+
+    def __init__(self, socket_path, connect_timeout=0.5, timeout=30):
+        self.socket_path = socket_path
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise DaemonUnavailable(str(e))
+        sock.settimeout(self.timeout)
+        return sock
+
+    def disconnect(self):
+        sock = getattr(self.local, 'sock', None)
+        self.local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def lint(self, path, **options):
+        """Lint path in the daemon. Raises DaemonUnavailable if it can't be reached."""
+        # The daemon has its own working directory
+        if options.get('annotate_to'):
+            options['annotate_to'] = os.path.abspath(options['annotate_to'])
+        request = {'path': os.path.abspath(path), 'options': options}
+        reused = getattr(self.local, 'sock', None) is not None
+        if not reused:
+            self.local.sock = self.connect()
+        try:
+            send_message(self.local.sock, request)
+            response = recv_message(self.local.sock)
+        except socket.timeout:
+            self.disconnect()
+            raise DocumentTooComplex(f'No result from the lint server after {self.timeout}s')
+        except (EOFError, OSError):
+            self.disconnect()
+            if reused:
+                # The daemon was restarted since this connection was opened
+                return self.lint(path, **options)
+            raise DaemonUnavailable('Lint server closed the connection')
+        return unpack_result(response['status'], response['payload'])
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            config = settings.LINTER_DAEMON
+            _client = LintClient(config['socket_path'], config['connect_timeout'], config['timeout'])
+        return _client
@@ -0,0 +1,67 @@
+"""
+Read Flat OPC files, Word's single-file XML packages, without building a DOM.
+
+The file is streamed with iterparse. Each body paragraph of the main document
+part is handed to the linter as soon as its end tag is parsed and cleared
+once the linter is done with it, so memory doesn't grow with the document.
+"""
+from docx.text.paragraph import Paragraph
+from lxml import etree as ET
+
+from .utils import FLAT_OPC, MAIN_CONTENT_TYPES, BadDocument
+
+try:
+    from docx.oxml.parser import element_class_lookup
+except ImportError:
+    # python-docx < 1.0
+    from docx.oxml import element_class_lookup
+
+PKG = 'http://schemas.microsoft.com/office/2006/xmlPackage'
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+PART = f'{{{PKG}}}part'
+CONTENT_TYPE = f'{{{PKG}}}contentType'
+BODY = f'{{{W}}}body'
+P = f'{{{W}}}p'
+
+def discard(elem):
+    """Free elem and everything parsed before it under the same parent."""
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+class FlatOpcDocument:
+    """Just enough of python-docx's Document for lint(): paragraphs, streamed."""
+    format = FLAT_OPC
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def paragraphs(self):
+        """Body paragraphs of the main document part, in order. Can only be iterated once."""
+        return self.iter_paragraphs()
+
+    def iter_paragraphs(self):
+        # python-docx's element classes give the paragraphs .text, pPr etc.
+        context = ET.iterparse(self.path, events=('start', 'end'), remove_blank_text=True, resolve_entities=False, no_network=True)
+        context.set_element_class_lookup(element_class_lookup)
+        in_main = found = False
+        try:
+            for event, elem in context:
+                if elem.tag == PART:
+                    if event == 'start':
+                        in_main = elem.get(CONTENT_TYPE) in MAIN_CONTENT_TYPES
+                        found = found or in_main
+                    else:
+                        in_main = False
+                        discard(elem)
+                elif event == 'end' and in_main and elem.getparent().tag == BODY:
+                    if elem.tag == P:
+                        yield Paragraph(elem, None)
+                    discard(elem)
+        except ET.XMLSyntaxError as e:
+            raise BadDocument(str(e))
+        if not found:
+            raise BadDocument('No main document part in the Flat OPC package')
@@ -2,8 +2,16 @@ from django import forms
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import HTML, Layout, Div, Field
 
+# Values match utils.ACCEPTED and utils.ORIGINAL
+TRACKED_CHANGES_VIEWS = [
+    ('accepted', 'As if all tracked changes were accepted'),
+    ('original', 'As it was before the tracked changes'),
+]
+
 class UploadFileForm(forms.Form):
-    file = forms.FileField(label="Upload SpringCM Template (.docx) - Max. 2MB")
+    file = forms.FileField(label="Upload SpringCM Template (.docx, .docm, .dotx or Flat OPC .xml) - Max. 2MB")
+    view = forms.ChoiceField(required=False, choices=TRACKED_CHANGES_VIEWS, label="Check the template")
+    annotate = forms.BooleanField(required=False, label="Download a copy of my template with a Word comment at each error instead")
     terms = forms.BooleanField(label="I acknowledge this was built for fun so there are NO WARRANTIES. I'm using this at my own risk.")
 
     def __init__(self, *args, **kwargs):
@@ -13,6 +21,8 @@ class UploadFileForm(forms.Form):
         self.helper.form_action = 'linter:index'
         self.helper.layout = Layout(
             Field('file'),
+            Field('view'),
+            Field('annotate', template="linter/custom_checkbox.html"),
             HTML('<hr />'),
             Field('terms', template="linter/custom_checkbox.html"),
             HTML('<button type="submit" class="btn btn-primary"><span class="far fa-eye"></span> Check Template for Errors</button>')
@@ -0,0 +1,177 @@
+import io
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from .loadtest import generate_template, percentile, rss_mb
+
+def lint_bytes(content):
+    from docx import Document
+    from springcm_tools.linter.utils import lint
+
+    return len(lint(Document(io.BytesIO(content))))
+
+def _process_main(templates, count, conn):
+    start = time.monotonic()
+    for index in range(count):
+        lint_bytes(templates[index % len(templates)])
+    conn.send((time.monotonic() - start, rss_mb(os.getpid())))
+    conn.close()
+
+class Command(BaseCommand):
+    help = 'Compares lint throughput and memory of threads sharing one warm process against forked processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=multiprocessing.cpu_count(), help='Threads or processes linting at once')
+        parser.add_argument('--lints', type=int, default=200, help='Lints per run')
+        parser.add_argument('--paragraphs', type=int, default=200, help='Paragraphs per generated template')
+        parser.add_argument('--templates', type=int, default=5, help='Number of distinct generated templates')
+        parser.add_argument('--daemon', action='store_true', help='Instead, compare the latency of one lint at a time through a lint_server daemon with linting in-process')
+        parser.add_argument('--output', help='Write JSON results here instead of stdout')
+
+    def handle(self, *args, **options):
+        from springcm_tools.linter.utils import warm
+
+        templates = [generate_template(options['paragraphs'], seed) for seed in range(options['templates'])]
+        # Warm up in the parent so both models start from the same preloaded state, like gunicorn's master
+        warm()
+        lint_bytes(templates[0])
+
+        if options['daemon']:
+            results = self.run_daemon(templates, options)
+        else:
+            results = {
+                'concurrency': options['concurrency'],
+                'lints': options['lints'],
+                'baseline_rss_mb': rss_mb(os.getpid()),
+                'gthread': self.run_threads(templates, options),
+                'sync': self.run_processes(templates, options),
+            }
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_threads(self, templates, options):
+        peak = [rss_mb(os.getpid()) or 0]
+        done = threading.Event()
+
+        def sample_rss():
+            while not done.wait(0.1):
+                peak[0] = max(peak[0], rss_mb(os.getpid()) or 0)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            list(pool.map(lambda index: lint_bytes(templates[index % len(templates)]), range(options['lints'])))
+        elapsed = time.monotonic() - start
+        done.set()
+        sampler.join()
+        return {
+            'elapsed_s': elapsed,
+            'throughput_lps': options['lints'] / elapsed,
+            'rss_mb': {'total': peak[0]},
+        }
+
+    def run_processes(self, templates, options):
+        context = multiprocessing.get_context('fork')
+        per_process = -(-options['lints'] // options['concurrency'])
+        workers = []
+        start = time.monotonic()
+        for _ in range(options['concurrency']):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_process_main, args=(templates, per_process, child_conn))
+            process.start()
+            child_conn.close()
+            workers.append((process, parent_conn))
+        reports = [conn.recv() for _, conn in workers]
+        elapsed = time.monotonic() - start
+        for process, _ in workers:
+            process.join()
+        # RSS counts pages still shared copy-on-write with the parent in every worker, so this overstates a little
+        worker_rss = sorted(rss for _, rss in reports if rss is not None)
+        return {
+            'elapsed_s': elapsed,
+            'throughput_lps': per_process * options['concurrency'] / elapsed,
+            'rss_mb': {'workers': worker_rss, 'total': (rss_mb(os.getpid()) or 0) + sum(worker_rss)},
+        }
+
+    def run_daemon(self, templates, options):
+        from springcm_tools.linter.daemon import LintClient
+        from springcm_tools.linter.utils import lint_path
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # A one-paragraph document shows the fixed per-request cost, the generated templates a typical lint
+            documents = {'empty': [generate_template(1, 0)], 'template': templates}
+            paths = {}
+            for kind, contents in documents.items():
+                paths[kind] = []
+                for index, content in enumerate(contents):
+                    path = os.path.join(tmpdir, f'{kind}{index}.docx')
+                    with open(path, 'wb') as f:
+                        f.write(content)
+                    paths[kind].append(path)
+
+            socket_path = os.path.join(tmpdir, 'lint.sock')
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'django', 'lint_server', '--socket', socket_path, '--workers', '1'],
+                stdout=subprocess.DEVNULL,
+            )
+            try:
+                client = LintClient(socket_path)
+                self.wait_for_daemon(server, socket_path)
+                results = {'lints': options['lints']}
+                for kind, kind_paths in paths.items():
+                    in_process = self.latencies(lint_path, kind_paths, options['lints'])
+                    daemon = self.latencies(client.lint, kind_paths, options['lints'])
+                    results[kind] = {
+                        'in_process_ms': in_process,
+                        'daemon_ms': daemon,
+                        'overhead_ms': daemon['p50'] - in_process['p50'],
+                    }
+                return results
+            finally:
+                server.terminate()
+                server.wait()
+
+    def wait_for_daemon(self, server, socket_path):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError('lint_server exited during startup')
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(socket_path)
+                return
+            except OSError:
+                time.sleep(0.1)
+            finally:
+                sock.close()
+        raise CommandError('lint_server did not start within 30s')
+
+    def latencies(self, lint, paths, count):
+        # One untimed lint each, so neither side pays for cold caches
+        for path in paths:
+            lint(path)
+        timings = []
+        for index in range(count):
+            start = time.perf_counter()
+            lint(paths[index % len(paths)])
+            timings.append((time.perf_counter() - start) * 1000)
+        return {
+            'mean': sum(timings) / len(timings),
+            'p50': percentile(timings, 50),
+            'p95': percentile(timings, 95),
+        }
@@ -0,0 +1,109 @@
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter: boot Django and resolve the index page the way a
+# worker would before serving its first GET.
+STARTUP_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.urls import resolve
+resolve('/')
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({'elapsed_ms': elapsed, 'modules': sorted(sys.modules), 'imports': IMPORTS}))
+"""
+
+# -X importtime needs Python 3.7, and production runs 3.6. There, time the
+# outermost imports of modules that aren't loaded yet by wrapping __import__.
+IMPORT_HOOK = """
+import builtins, sys, time
+IMPORTS = []
+_import = builtins.__import__
+_depth = [0]
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if _depth[0] or level or name in sys.modules:
+        _depth[0] += 1
+        try:
+            return _import(name, globals, locals, fromlist, level)
+        finally:
+            _depth[0] -= 1
+    _depth[0] += 1
+    start = time.perf_counter()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        _depth[0] -= 1
+        IMPORTS.append((name, (time.perf_counter() - start) * 1000))
+builtins.__import__ = _timed_import
+"""
+
+class Command(BaseCommand):
+    help = 'Measures worker cold start time and import time per top-level module'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15, help='Number of modules to report')
+        parser.add_argument('--preload', action='store_true', help='Warm the linter in AppConfig.ready() like the gunicorn master does')
+        parser.add_argument('--max-ms', type=float, help='Fail if startup takes longer than this')
+        parser.add_argument('--forbid', default='', help='Comma-separated modules that must not be imported at startup, e.g. lxml,docx')
+        parser.add_argument('--json', action='store_true', help='Emit results as JSON')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, LINTER_PRELOAD='true' if options['preload'] else 'false')
+        if sys.version_info >= (3, 7):
+            command = [sys.executable, '-X', 'importtime', '-c', 'IMPORTS = None\n' + STARTUP_CODE]
+        else:
+            command = [sys.executable, '-c', IMPORT_HOOK + STARTUP_CODE]
+        proc = subprocess.run(
+            command,
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        )
+        if proc.returncode:
+            raise CommandError(proc.stderr)
+
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        modules = set(result.pop('modules'))
+        hooked = result.pop('imports')
+        imports = self.group_imports(hooked) if hooked is not None else self.parse_importtime(proc.stderr)
+        if not imports:
+            raise CommandError('No import times were recorded')
+        result['imports'] = imports[:options['top']]
+
+        forbidden = [name for name in options['forbid'].split(',') if name]
+        result['forbidden_imported'] = [name for name in forbidden if name in modules]
+
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+        else:
+            self.stdout.write(f"Startup: {result['elapsed_ms']:.1f} ms")
+            for name, ms in result['imports']:
+                self.stdout.write(f"  {ms:8.1f} ms  {name}")
+
+        if result['forbidden_imported']:
+            raise CommandError('Imported at startup: ' + ', '.join(result['forbidden_imported']))
+        if options['max_ms'] and result['elapsed_ms'] > options['max_ms']:
+            raise CommandError(f"Startup took {result['elapsed_ms']:.1f} ms, limit is {options['max_ms']} ms")
+
+    def parse_importtime(self, output):
+        """Sum cumulative import time of the outermost imports, grouped by top-level package."""
+        imports = []
+        for line in output.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            # Nested imports are indented under the module that imported them
+            if name.startswith('  '):
+                continue
+            imports.append((name.strip(), int(cumulative) / 1000))
+        return self.group_imports(imports)
+
+    def group_imports(self, imports):
+        totals = defaultdict(float)
+        for name, ms in imports:
+            totals[name.split('.')[0]] += ms
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,59 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = 'Lints templates, in the lint daemon if it is running and in-process otherwise'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', metavar='path')
+        parser.add_argument('--view', choices=['accepted', 'original'], default='accepted', help='Lint with tracked changes accepted (default) or as the original')
+        parser.add_argument('--no-daemon', action='store_true', help="Always lint in-process, even if the daemon is running")
+        parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+
+    def handle(self, *args, **options):
+        from springcm_tools.linter.sandbox import DocumentTooComplex
+        from springcm_tools.linter.utils import BadDocument
+
+        lint = self.linter(options['no_daemon'])
+        reports = {}
+        failed = 0
+        for path in options['paths']:
+            try:
+                reports[path] = lint(path, view=options['view'])
+            except BadDocument as e:
+                self.stderr.write(f'{path}: not a Word document ({e})')
+                failed += 1
+            except DocumentTooComplex as e:
+                self.stderr.write(f'{path}: too complex to lint ({e})')
+                failed += 1
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+        else:
+            for path, report in reports.items():
+                self.stdout.write(f"{path}: {len(report['errors'])} errors")
+                for error in report['errors']:
+                    self.stdout.write(f"  Paragraph #{error['paragraph']}: {error['error']}  {error['directive_string']}")
+
+        errors = sum(len(report['errors']) for report in reports.values())
+        if errors or failed:
+            raise CommandError(f'{errors} errors in {len(options["paths"])} files' + (f', {failed} could not be opened' if failed else ''))
+
+    def linter(self, no_daemon):
+        from springcm_tools.linter.utils import lint_path
+
+        if no_daemon or not settings.LINTER_DAEMON:
+            return lint_path
+        from springcm_tools.linter.daemon import DaemonUnavailable, get_client
+        from springcm_tools.linter.sandbox import SandboxBusy
+        client = get_client()
+
+        def lint(path, **options):
+            try:
+                return client.lint(path, **options)
+            except (DaemonUnavailable, SandboxBusy):
+                # Nobody is waiting on a web request here, so lint in-process rather than give up
+                return lint_path(path, **options)
+        return lint
@@ -0,0 +1,36 @@
+import multiprocessing
+import signal
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = 'Runs the lint daemon that web workers and the lint command send lints to over a Unix socket'
+
+    def add_arguments(self, parser):
+        config = settings.LINTER_DAEMON or {}
+        parser.add_argument('--socket', default=config.get('socket_path'), help='Unix socket to listen on. Defaults to LINTER_DAEMON_SOCKET.')
+        parser.add_argument('--workers', type=int, default=config.get('workers', multiprocessing.cpu_count()), help='Sandbox worker processes')
+        parser.add_argument('--queue-wait', type=float, default=config.get('queue_wait', 10), help='Seconds a lint waits for a free worker before it is turned away')
+
+    def handle(self, *args, **options):
+        from springcm_tools.linter.daemon import LintServer
+
+        if not options['socket']:
+            raise CommandError('Pass --socket or set LINTER_DAEMON=true')
+        try:
+            server = LintServer(options['socket'], options['workers'], options['queue_wait'])
+        except OSError as e:
+            raise CommandError(str(e))
+
+        # supervisor stops us with SIGTERM. Exit through the finally so the socket and workers are cleaned up.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.stdout.write(f"Listening on {options['socket']} with {options['workers']} workers")
+        self.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
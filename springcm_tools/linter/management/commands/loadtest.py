@@ -0,0 +1,258 @@
+import http.client
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+HOST = '127.0.0.1'
+# `python -m gunicorn` only works from gunicorn 20.1, and production pins 19.9
+RUN_GUNICORN = 'from gunicorn.app.wsgiapp import run; run()'
+
+# A mix of clean and broken directives, so generated templates exercise every error path.
+DIRECTIVES = [
+    '<# <Content Select="//Foo" Optional="true" /> #>',
+    '<# <Content Select="//Foo" > #>',
+    '<# <Content Select="\\badxpath" /> #>',
+    '<# <BadTagType Select="//Foo" /> #>',
+    '<# <SuppressParagraph Select="//Foo" Match="" /> #> Hello',
+]
+
+def default_configs():
+    cpus = multiprocessing.cpu_count()
+    return [
+        f'sync:{cpus * 2 + 1}', # current production setting
+        f'sync:{cpus}',
+        f'sync:{cpus * 4}',
+        f'gthread:{cpus}x4',
+    ]
+
+def parse_config(config):
+    """'sync:9' -> ('sync', 9, 1), 'gthread:2x4' -> ('gthread', 2, 4)"""
+    match = re.fullmatch(r'(\w+):(\d+)(?:x(\d+))?', config)
+    if not match:
+        raise CommandError(f"Bad --config '{config}', expected e.g. sync:9 or gthread:2x4")
+    worker_class, workers, threads = match.groups()
+    return worker_class, int(workers), int(threads or 1)
+
+def generate_template(paragraphs, seed):
+    from docx import Document
+
+    rng = random.Random(seed)
+    document = Document()
+    for _ in range(paragraphs):
+        document.add_paragraph(rng.choice(DIRECTIVES) if rng.random() < 0.5 else 'Plain text paragraph.')
+    stream = io.BytesIO()
+    document.save(stream)
+    return stream.getvalue()
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    # Nearest-rank percentile
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # ppid is the 4th field, after the parenthesised command name
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+def simulated_address(index):
+    """A distinct client address per upload, so uploads aren't all one client to admission control."""
+    return f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}'
+
+class Client:
+    def __init__(self, port, path):
+        self.port = port
+        self.path = path
+        self.cookie, self.token = self.csrf()
+
+    def request(self, method, body=None, headers=None):
+        conn = http.client.HTTPConnection(HOST, self.port, timeout=60)
+        try:
+            conn.request(method, self.path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, response.getheader('Set-Cookie', ''), response.read()
+        finally:
+            conn.close()
+
+    def csrf(self):
+        _, set_cookie, body = self.request('GET')
+        cookie = re.search(r'csrftoken=([^;]+)', set_cookie).group(1)
+        token = re.search(rb'name="csrfmiddlewaretoken" value="([^"]+)"', body).group(1).decode()
+        return cookie, token
+
+    def upload(self, filename, content, client_address=None):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in [('csrfmiddlewaretoken', self.token), ('terms', 'on')]:
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/vnd.openxmlformats-officedocument.wordprocessingml.document\r\n\r\n'.encode()
+            + content + b'\r\n'
+        )
+        parts.append(f'--{boundary}--\r\n'.encode())
+        headers = {
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Cookie': f'csrftoken={self.cookie}',
+            'Referer': f'http://{HOST}:{self.port}{self.path}',
+        }
+        if client_address:
+            # Admission control allows each client address one lint at a time, and nginx passes it in X-Real-IP
+            headers['X-Real-IP'] = client_address
+        status, _, _ = self.request('POST', b''.join(parts), headers)
+        return status
+
+class Command(BaseCommand):
+    help = 'Runs the app under gunicorn locally and load tests the upload endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--config', action='append', dest='configs', help='Worker config, e.g. sync:9 or gthread:2x4 (repeatable). Defaults to the production setting and a few alternatives.')
+        parser.add_argument('--rate', type=float, default=10, help='Uploads per second')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to run each config')
+        parser.add_argument('--concurrency', type=int, default=64, help='Maximum uploads in flight')
+        parser.add_argument('--paragraphs', type=int, default=200, help='Paragraphs per generated template')
+        parser.add_argument('--templates', type=int, default=5, help='Number of distinct generated templates')
+        parser.add_argument('--port', type=int, default=8099)
+        parser.add_argument('--output', help='Write JSON results here instead of stdout')
+
+    def handle(self, *args, **options):
+        templates = [generate_template(options['paragraphs'], seed) for seed in range(options['templates'])]
+        results = []
+        for config in options['configs'] or default_configs():
+            self.stderr.write(f'Running {config}...')
+            results.append(self.run_config(config, templates, options))
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_config(self, config, templates, options):
+        worker_class, workers, threads = parse_config(config)
+        upload_dir = tempfile.TemporaryDirectory()
+        env = dict(os.environ, DJANGO_UPLOAD_DIR=upload_dir.name)
+        server = subprocess.Popen(
+            [sys.executable, '-c', RUN_GUNICORN, 'config.wsgi:application',
+             '--bind', f"{HOST}:{options['port']}", '--workers', str(workers),
+             '--worker-class', worker_class, '--threads', str(threads), '--log-level', 'error'],
+            env=env,
+        )
+        try:
+            client = self.wait_for_server(server, options['port'])
+            return dict(
+                config=config, worker_class=worker_class, workers=workers, threads=threads,
+                **self.run_load(server, client, templates, options),
+            )
+        finally:
+            server.terminate()
+            server.wait()
+            upload_dir.cleanup()
+
+    def wait_for_server(self, server, port):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError('gunicorn exited during startup')
+            try:
+                return Client(port, reverse('linter:index'))
+            except (OSError, AttributeError):
+                time.sleep(0.2)
+        raise CommandError('gunicorn did not start within 30s')
+
+    def run_load(self, server, client, templates, options):
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+        rss = {}
+        done = threading.Event()
+
+        def upload(index, scheduled):
+            nonlocal errors
+            try:
+                status = client.upload(f'load{index}.docx', templates[index % len(templates)], simulated_address(index))
+            except (OSError, http.client.HTTPException):
+                status = None
+            # Measure from the scheduled send time so client-side queueing counts as latency
+            elapsed = (time.monotonic() - scheduled) * 1000
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+        def sample_rss():
+            while not done.wait(0.5):
+                for pid in child_pids(server.pid):
+                    mb = rss_mb(pid)
+                    if mb is not None:
+                        rss[pid] = max(rss.get(pid, 0), mb)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+        total = int(options['rate'] * options['duration'])
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            for index in range(total):
+                scheduled = start + index / options['rate']
+                time.sleep(max(0, scheduled - time.monotonic()))
+                pool.submit(upload, index, scheduled)
+        elapsed = time.monotonic() - start
+        done.set()
+        sampler.join()
+
+        return {
+            'requests': total,
+            'ok': len(latencies),
+            'errors': errors,
+            'error_rate': errors / total if total else 0,
+            'throughput_rps': len(latencies) / elapsed,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies, default=None),
+            },
+            'rss_mb': {
+                'master': rss_mb(server.pid),
+                'workers': sorted(rss.values()),
+                'total': (rss_mb(server.pid) or 0) + sum(rss.values()),
+            },
+        }
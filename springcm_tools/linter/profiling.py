@@ -0,0 +1,91 @@
+"""
+Opt-in cProfile capture of individual lints.
+
+Profiles are kept in a bounded on-disk ring buffer: each one is a .prof file
+plus a .json file of document stats, and the oldest are deleted once there
+are more than LINTER_PROFILE['keep'].
+"""
+import cProfile
+import json
+import os
+import random
+import re
+import time
+import uuid
+from datetime import datetime
+from time import perf_counter
+
+from django.conf import settings
+
+from .utils import ACCEPTED, build_report, open_document
+
+PROFILE_ID = re.compile(r'^\d{20}-[0-9a-f]{8}$')
+
+def should_profile(request):
+    if not settings.LINTER_PROFILE:
+        return False
+    if 'profile' in request.GET and request.user.is_staff:
+        return True
+    return random.random() < settings.LINTER_PROFILE['sample_rate']
+
+def profile_dir():
+    return settings.LINTER_PROFILE['dir']
+
+def profile_lint_path(path, name=None, view=ACCEPTED):
+    stats = {'name': name or os.path.basename(path), 'stages': {}}
+    profiler = cProfile.Profile()
+    start = perf_counter()
+    profiler.enable()
+    try:
+        document = open_document(path)
+        opened = perf_counter()
+        report = build_report(document, stats, view)
+    finally:
+        profiler.disable()
+    stats['stages']['open'] = opened - start
+    stats['elapsed'] = perf_counter() - start
+    record(profiler, stats)
+    return report, document
+
+def record(profiler, stats):
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    # Timestamp first so ids sort oldest to newest
+    profile_id = datetime.now().strftime('%Y%m%d%H%M%S%f') + '-' + uuid.uuid4().hex[:8]
+    stats['id'] = profile_id
+    stats['time'] = time.time()
+    profiler.dump_stats(os.path.join(directory, profile_id + '.prof'))
+    with open(os.path.join(directory, profile_id + '.json'), 'w') as f:
+        json.dump(stats, f)
+    prune(directory, settings.LINTER_PROFILE['keep'])
+
+def prune(directory, keep):
+    ids = sorted(filename[:-5] for filename in os.listdir(directory) if filename.endswith('.json'))
+    for profile_id in ids[:-keep] if keep else ids:
+        for extension in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, profile_id + extension))
+            except FileNotFoundError:
+                # Another worker pruned it first
+                pass
+
+def slowest(count):
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in os.listdir(directory):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return sorted(profiles, key=lambda stats: stats['elapsed'], reverse=True)[:count]
+
+def profile_path(profile_id):
+    """Path of the .prof file for profile_id, or None if there isn't one."""
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(profile_dir(), profile_id + '.prof')
+    return path if os.path.exists(path) else None
@@ -0,0 +1,182 @@
+"""
+Run lints in a pool of pre-forked, resource-limited worker processes.
+
+A pathological upload can only take down its own sandbox worker, which is
+killed and replaced, instead of pinning the web worker that received it.
+"""
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import threading
+
+from django.conf import settings
+
+from .utils import BadDocument, lint_path, warm
+
+MB = 1024 * 1024
+
+class DocumentTooComplex(Exception):
+    """The lint hit a resource limit or the wall-clock timeout and was killed."""
+
+class SandboxBusy(Exception):
+    """No worker became free within the pool's queue_wait, so the lint wasn't run."""
+
+def _address_space():
+    """Current virtual memory size of this process in bytes, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        return None
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _set_soft_limit(limit, soft):
+    """Set limit's soft value, capped at its hard limit since setrlimit() rejects anything above."""
+    _, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(limit, (soft, hard))
+
+def _close_inherited_fds(keep):
+    """
+    Close every descriptor above stdio except keep. Workers are forked from web
+    workers mid-request, and an inherited client socket would keep that
+    connection open until the worker exits.
+    """
+    max_fd = os.sysconf('SC_OPEN_MAX')
+    os.closerange(3, keep)
+    os.closerange(keep + 1, max_fd if max_fd > 0 else 65536)
+
+def _worker_main(conn, cpu_seconds, memory_mb):
+    _close_inherited_fds(conn.fileno())
+    # Validators are per thread, so a worker forked from any thread but the one that warmed
+    # up (e.g. a replacement spawned by a daemon handler) would otherwise compile on its first job
+    warm()
+
+    # The address space limit is headroom on top of what was inherited at fork
+    current = _address_space() or 0
+    _set_soft_limit(resource.RLIMIT_AS, current + memory_mb * MB)
+
+    while True:
+        try:
+            path, options = conn.recv()
+        except EOFError:
+            return
+
+        # RLIMIT_CPU counts total CPU time, so give each job a fresh allowance.
+        # Going over sends SIGXCPU, which kills the worker.
+        _set_soft_limit(resource.RLIMIT_CPU, int(_cpu_time()) + cpu_seconds)
+
+        try:
+            result = ('ok', lint_path(path, **options))
+        except BadDocument as e:
+            result = ('bad_document', str(e))
+        except (MemoryError, RecursionError):
+            result = ('too_complex', 'Ran out of memory')
+        except Exception as e:
+            result = ('error', repr(e))
+
+        # ru_maxrss is in kilobytes on Linux
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        conn.send(result + (rss_mb,))
+
+def unpack_result(status, payload):
+    """The report from a worker's (status, payload) result, or the exception it stands for."""
+    if status == 'bad_document':
+        raise BadDocument(payload)
+    if status == 'too_complex':
+        raise DocumentTooComplex(payload)
+    if status == 'busy':
+        raise SandboxBusy(payload)
+    if status == 'error':
+        raise RuntimeError(f'Lint failed in sandbox: {payload}')
+    return payload
+
+class Worker:
+    def __init__(self, cpu_seconds, memory_mb):
+        # fork, so the worker inherits the warmed schema and Django setup
+        context = multiprocessing.get_context('fork')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, cpu_seconds, memory_mb), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def kill(self):
+        # Process.kill() needs Python 3.7
+        os.kill(self.process.pid, signal.SIGKILL)
+        self.process.join()
+        self.conn.close()
+
+class SandboxPool:
+    def __init__(self, size=1, cpu_seconds=10, memory_mb=512, timeout=15, max_jobs=100, max_rss_mb=300, queue_wait=None):
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.queue_wait = queue_wait
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        return Worker(self.cpu_seconds, self.memory_mb)
+
+    def lint(self, path, **options):
+        """
+        Lint path in a sandbox worker. options are passed through to utils.lint_path.
+        Raises SandboxBusy if no worker is free within queue_wait seconds (None waits forever).
+        """
+        try:
+            worker = self.idle.get(timeout=self.queue_wait)
+        except queue.Empty:
+            raise SandboxBusy(f'No sandbox worker free after {self.queue_wait}s')
+        try:
+            worker.conn.send((path, options))
+            if not worker.conn.poll(self.timeout):
+                raise DocumentTooComplex(f'Timed out after {self.timeout}s')
+            status, payload, rss_mb = worker.conn.recv()
+        except (EOFError, OSError):
+            # The worker died mid-job, most likely SIGXCPU or running out of address space
+            worker.kill()
+            worker = self.spawn()
+            raise DocumentTooComplex('Worker was killed')
+        except DocumentTooComplex:
+            worker.kill()
+            worker = self.spawn()
+            raise
+        else:
+            worker.jobs += 1
+            if status == 'too_complex' or worker.jobs >= self.max_jobs or rss_mb > self.max_rss_mb:
+                worker.kill()
+                worker = self.spawn()
+        finally:
+            self.idle.put(worker)
+
+        return unpack_result(status, payload)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().kill()
+            except queue.Empty:
+                return
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The pool for this process, created on first use so gunicorn workers don't share one forked from the master."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = SandboxPool(**settings.LINTER_SANDBOX)
+            _pool_pid = os.getpid()
+        return _pool
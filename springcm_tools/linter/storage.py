@@ -0,0 +1,91 @@
+import gzip
+import os
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+from .csspurge import purge_css, used_tokens
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.xml', '.map', '.ico', '.ttf', '.eot', '.otf')
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Hashed filenames plus .gz and (if brotli is installed) .br copies of each
+    hashed text asset, for nginx's gzip_static/brotli_static. With
+    LINTER_PURGE_CSS, CSS rules for classes the site never uses are dropped
+    before hashing.
+    """
+    # We don't ship source maps in production, so sourceMappingURL comments
+    # must not be treated as references to files that have to exist.
+    patterns = tuple(
+        (extension, tuple(
+            pattern for pattern in extension_patterns
+            if 'sourceMappingURL' not in (pattern[0] if isinstance(pattern, tuple) else pattern)
+        ))
+        for extension, extension_patterns in ManifestStaticFilesStorage.patterns
+    )
+
+    def hashed_name(self, name, content=None, filename=None):
+        try:
+            return super().hashed_name(name, content, filename)
+        except ValueError:
+            # Some vendored CSS points at files the vendor never shipped. Leave those URLs alone.
+            if content is None and not self.exists(name):
+                return name
+            raise
+
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            yield from super().post_process(paths, dry_run, **options)
+            return
+
+        if getattr(settings, 'LINTER_PURGE_CSS', False):
+            self.purge(paths)
+
+        yield from super().post_process(paths, dry_run, **options)
+
+        for name in set(self.hashed_files.values()):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self.compress(name)
+
+    def purge(self, paths):
+        texts = []
+        for app_config in apps.get_app_configs():
+            template_dir = os.path.join(app_config.path, 'templates')
+            for root, _, files in os.walk(template_dir):
+                for filename in files:
+                    with open(os.path.join(root, filename), encoding='utf-8', errors='ignore') as f:
+                        texts.append(f.read())
+        for name in paths:
+            if name.endswith('.js'):
+                with self.open(name) as f:
+                    texts.append(f.read().decode('utf-8', errors='ignore'))
+        used = used_tokens(texts)
+
+        for name in paths:
+            if name.endswith('.css'):
+                with self.open(name) as f:
+                    css = f.read().decode('utf-8')
+                self.delete(name)
+                self._save(name, ContentFile(purge_css(css, used).encode('utf-8')))
+                # Hash the purged copy rather than the original in the app's static dir
+                paths[name] = (self, name)
+
+    def compress(self, name):
+        with self.open(name) as f:
+            content = f.read()
+        compressed = [('.gz', gzip.compress(content, 9))]
+        if brotli:
+            compressed.append(('.br', brotli.compress(content)))
+        for extension, data in compressed:
+            if len(data) < len(content):
+                if self.exists(name + extension):
+                    self.delete(name + extension)
+                self._save(name + extension, ContentFile(data))
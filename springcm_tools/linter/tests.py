@@ -1,11 +1,38 @@
-from django.test import SimpleTestCase
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.urls import reverse
+from unittest import mock
+import io
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 from docx import Document
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
+from lxml import etree
 from xml.etree import ElementTree as ET
-from .utils import lint
+from . import admission, daemon, sandbox, views
+from .admission import AdmissionController, Saturated
+from .annotate import COMMENTS_CONTENT_TYPE, COMMENTS_REL, W
+from .csspurge import purge_css, used_tokens
+from .daemon import LintClient, LintServer, recv_message, send_message
+from .flatopc import PKG
+from .management.commands.loadtest import parse_config, percentile, simulated_address
+from .profiling import profile_path, should_profile, slowest
+from .sandbox import DocumentTooComplex, SandboxBusy, SandboxPool
+from .utils import MAIN_CONTENT_TYPES, BadDocument, ConditionalRegion, RegionIndex, build_report, check_tag, lint, lint_path, serialize_errors
+from .views import MAX_OUTLINE_NESTING, lint_upload, outline_html
 
 TYPE_UNORDERED = "1"
 TYPE_ORDERED = "5"
@@ -37,6 +64,27 @@ def ms_wordify(input, ul_paragraphs=[], ol_paragraphs=[]):
 
     return document
 
+class TempDirMixin:
+    """Gives each test its own temporary directory, self.tmpdir, to save documents in."""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def save(self, input, name='template.docx'):
+        path = os.path.join(self.tmpdir, name)
+        ms_wordify(input).save(path)
+        return path
+
+def docx_upload(document, name="template.docx"):
+    stream = io.BytesIO()
+    document.save(stream)
+    stream.seek(0)
+    stream.name = name
+    return stream
+
 
 class LintTests(SimpleTestCase):
     def test_unrecognized_tag(self):
@@ -479,3 +527,723 @@ class SuppressParagraphTagTests(SimpleTestCase):
         self.assertEqual(res[0].error, "Invalid attributes")
 
 
+class ReportTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        settings = override_settings(UPLOAD_DIR=self.tmpdir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def upload(self, input):
+        return self.client.post(reverse('linter:index'), {'file': docx_upload(ms_wordify(input)), 'terms': 'on'})
+
+    def test_serialize_errors(self):
+        """Serialized errors are plain dicts with the paragraph number and message"""
+        input = 'Hello\n<# <Content Select="//Foo" > #>'
+        res = serialize_errors(lint(ms_wordify(input)))
+        self.assertEqual(res, [{'paragraph': 1, 'error': "Missing self-closing tag />", 'directive_string': '<# <Content Select="//Foo" > #>', 'tracked_change': False}])
+
+    def test_streamed_report(self):
+        """The report is streamed with errors grouped by type and listed in order"""
+        input = '\n'.join(['<# <Content Select="//Foo" > #>'] * 600 + ['<# <Bad Select="//Foo" /> #>'])
+        response = self.upload(input)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('Total Number of Errors', content)
+        self.assertEqual(content.count('Missing self-closing tag /&gt;</span>'), 600)
+        self.assertIn('>600</span>', content)
+        self.assertIn('Paragraph #600: Unrecognized tag type', content)
+        self.assertLess(content.index('Errors by Type'), content.index('Paragraph #0:'))
+        self.assertIn('</html>', content)
+
+    def test_clean_report(self):
+        """A clean document streams the no-errors page"""
+        response = self.upload('<# <Content Select="//Foo" /> #>')
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('No errors to display', content)
+        self.assertIn('</html>', content)
+
+    def test_clean_report_with_outline(self):
+        """A clean document with a conditional gets its outline inside the page"""
+        response = self.upload('<# <Conditional Select="//Foo" Match="" /> #>\nHello\n<# <EndConditional /> #>')
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('No errors to display', content)
+        self.assertTrue(content.rstrip().endswith('</html>'))
+        self.assertNotIn('<!-- outline -->', content)
+        self.assertLess(content.index('Paragraphs #0'), content.index('</html>'))
+
+
+class StartupTests(SimpleTestCase):
+    def test_index_does_not_import_linter_dependencies(self):
+        """Serving the index page shouldn't pull in lxml or python-docx"""
+        call_command('bench_startup', forbid='lxml,docx', stdout=io.StringIO())
+
+    def test_import_times_without_importtime(self):
+        """Import times are still reported on Python 3.6, which has no -X importtime"""
+        stdout = io.StringIO()
+        with mock.patch.object(sys, 'version_info', (3, 6, 8)):
+            call_command('bench_startup', json=True, stdout=stdout)
+        self.assertIn('django', dict(json.loads(stdout.getvalue())['imports']))
+
+
+class LoadTestTests(SimpleTestCase):
+    def test_parse_config(self):
+        self.assertEqual(parse_config('sync:9'), ('sync', 9, 1))
+        self.assertEqual(parse_config('gthread:2x4'), ('gthread', 2, 4))
+        with self.assertRaises(CommandError):
+            parse_config('gthread')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_simulated_addresses_distinct(self):
+        self.assertEqual(len({simulated_address(index) for index in range(70000)}), 70000)
+
+
+class SandboxTests(TempDirMixin, SimpleTestCase):
+    def pool(self, **kwargs):
+        pool = SandboxPool(**kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_lint(self):
+        """Lints run in the sandbox give the same results as in-process"""
+        path = self.save('<# <Content Select="//Foo" > #>')
+        res = self.pool().lint(path)['errors']
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0]['error'], "Missing self-closing tag />")
+
+    def test_bad_document(self):
+        path = self.tmpdir + '/bad.docx'
+        with open(path, 'w') as f:
+            f.write('not a zip')
+        with self.assertRaises(BadDocument):
+            self.pool().lint(path)
+
+    def test_timeout(self):
+        """A lint that runs past the timeout is killed and the worker replaced"""
+        pool = self.pool(timeout=0.001)
+        worker = pool.idle.queue[0]
+        with self.assertRaises(DocumentTooComplex):
+            pool.lint(self.save('\n'.join(['<# <Content Select="//Foo" /> #>'] * 2000)))
+        self.assertFalse(worker.process.is_alive())
+        self.assertIsNot(pool.idle.queue[0], worker)
+
+    def test_inherited_sockets_closed(self):
+        """Workers don't hold on to sockets the web worker had open when they were forked"""
+        client, server = socket.socketpair()
+        with client, server:
+            pool = self.pool()
+            pool.lint(self.save('Hello'))
+            server.close()
+            client.settimeout(5)
+            self.assertEqual(client.recv(1), b'')
+
+    def test_soft_limit_capped_at_hard(self):
+        """A finite hard limit below the wanted soft limit caps it instead of failing the worker"""
+        with mock.patch.object(sandbox.resource, 'getrlimit', return_value=(100, 200)), mock.patch.object(sandbox.resource, 'setrlimit') as setrlimit:
+            sandbox._set_soft_limit(sandbox.resource.RLIMIT_AS, 500)
+            setrlimit.assert_called_with(sandbox.resource.RLIMIT_AS, (200, 200))
+        with mock.patch.object(sandbox.resource, 'getrlimit', return_value=(100, sandbox.resource.RLIM_INFINITY)), mock.patch.object(sandbox.resource, 'setrlimit') as setrlimit:
+            sandbox._set_soft_limit(sandbox.resource.RLIMIT_AS, 500)
+            setrlimit.assert_called_with(sandbox.resource.RLIMIT_AS, (500, sandbox.resource.RLIM_INFINITY))
+
+    def test_recycle_after_max_jobs(self):
+        pool = self.pool(max_jobs=2)
+        path = self.save('Hello')
+        first = pool.idle.queue[0]
+        pool.lint(path)
+        self.assertIs(pool.idle.queue[0], first)
+        pool.lint(path)
+        self.assertIsNot(pool.idle.queue[0], first)
+        self.assertEqual(pool.lint(path)['errors'], [])
+
+
+class AdmissionTests(TempDirMixin, SimpleTestCase):
+    def controller(self, **kwargs):
+        return AdmissionController(self.tmpdir, **dict({'wait': 0}, **kwargs))
+
+    def test_limits_concurrency(self):
+        """Requests past max_concurrent wait in the queue and are rejected when the wait runs out"""
+        controller = self.controller(max_concurrent=2, per_client=5)
+        with controller.admit('a'), controller.admit('b'):
+            self.assertEqual(controller.stats()['in_flight'], 2)
+            with self.assertRaises(Saturated) as cm:
+                with controller.admit('c'):
+                    pass
+            self.assertEqual(cm.exception.reason, 'timeout')
+        self.assertEqual(controller.stats()['in_flight'], 0)
+        with controller.admit('c'):
+            pass
+        self.assertEqual(controller.stats()['rejected'], {'timeout': 1})
+
+    def test_queue_full(self):
+        controller = self.controller(max_concurrent=1, queue=0)
+        with controller.admit('a'):
+            with self.assertRaises(Saturated) as cm:
+                with controller.admit('b'):
+                    pass
+            self.assertEqual(cm.exception.reason, 'queue_full')
+
+    def test_queued_request_is_admitted(self):
+        """A queued request gets the slot when it frees up"""
+        controller = self.controller(max_concurrent=1, wait=5)
+        admitted = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with controller.admit('a'):
+                admitted.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        admitted.wait()
+        threading.Timer(0.2, release.set).start()
+        with controller.admit('b'):
+            self.assertEqual(controller.stats()['queue_depth'], 0)
+        thread.join()
+
+    def test_per_client(self):
+        """One client can't hold more than its share of slots"""
+        controller = self.controller(max_concurrent=4, per_client=1)
+        with controller.admit('a'):
+            with self.assertRaises(Saturated) as cm:
+                with controller.admit('a'):
+                    pass
+            self.assertEqual(cm.exception.reason, 'client')
+            with controller.admit('b'):
+                pass
+
+    def test_queue_in_order(self):
+        """A free slot goes to the request that has waited longest, and a crashed waiter's ticket expires"""
+        controller = self.controller(max_concurrent=1, per_client=5, wait=0.2)
+        # Waiting in another worker process
+        ticket, first = controller.line_up()
+        self.assertTrue(first)
+        with self.assertRaises(Saturated) as cm:
+            with controller.admit('a'):
+                pass
+        self.assertEqual(cm.exception.reason, 'timeout')
+        time.sleep(1.3)
+        with controller.admit('a'):
+            pass
+        self.assertEqual(controller.line_up()[0], ticket + 3)
+
+    def test_client_slots_removed(self):
+        """Client slot files don't pile up in lock_dir, one per address"""
+        controller = self.controller(per_client=1)
+        for client in ['a', 'b', 'c']:
+            with controller.admit(client):
+                pass
+        self.assertEqual([name for name in os.listdir(controller.lock_dir) if name.startswith('client-')], [])
+
+    def test_stats_do_not_take_slots(self):
+        """Reading stats never makes an admit() find its slot taken"""
+        controller = self.controller(max_concurrent=1, queue=0)
+        done = threading.Event()
+
+        def poll_stats():
+            while not done.is_set():
+                controller.stats()
+
+        thread = threading.Thread(target=poll_stats)
+        thread.start()
+        try:
+            for _ in range(200):
+                with controller.admit('a'):
+                    pass
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(controller.stats()['rejected'], {})
+
+    def test_busy_response(self):
+        """A saturated upload gets a 503 with Retry-After"""
+        config = {'lock_dir': self.tmpdir, 'max_concurrent': 1, 'wait': 0, 'retry_after': 7}
+        with override_settings(LINTER_ADMISSION=config, UPLOAD_DIR=self.tmpdir):
+            admission._controller = None
+            self.addCleanup(setattr, admission, '_controller', None)
+            with admission.get_controller().admit('someone else'):
+                response = self.client.post(reverse('linter:index'), {'file': docx_upload(ms_wordify('Hello')), 'terms': 'on'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+
+
+class CssPurgeTests(SimpleTestCase):
+    def test_purge(self):
+        """Rules for classes that never appear in the templates are dropped"""
+        css = (
+            '@charset "UTF-8";/*! License */ /* note */'
+            '.used,.unused{color:red}.unused{color:blue}'
+            '@media (min-width:1px){.unused{x:y}.used .child:not(.unused){a:b}}'
+            '@font-face{font-family:"{x}"}div{content:"}"}'
+        )
+        used = used_tokens(['<div class="used child">'])
+        self.assertEqual(
+            purge_css(css, used),
+            '@charset "UTF-8";\n/*! License */\n'
+            '.used{color:red}@media (min-width:1px){.used .child:not(.unused){a:b}}'
+            '@font-face{font-family:"{x}"}div{content:"}"}',
+        )
+
+
+class Staff:
+    is_active = True
+    is_staff = True
+
+class ProfilingTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        profile = {'sample_rate': 0.0, 'dir': self.tmpdir + '/profiles', 'keep': 2, 'show': 10}
+        settings = override_settings(LINTER_PROFILE=profile)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_lint_stats(self):
+        """lint() fills in document counts and stage timings when asked"""
+        stats = {}
+        lint(ms_wordify('<# <Content Select="//Foo" /> #>\nHello\n<# <Bad /> #>'), stats)
+        self.assertEqual((stats['paragraphs'], stats['tags'], stats['errors']), (3, 2, 1))
+        self.assertEqual(set(stats['stages']), {'process', 'match', 'collect'})
+
+    def test_should_profile(self):
+        request = RequestFactory().post('/?profile')
+        request.user = Staff()
+        self.assertTrue(should_profile(request))
+        request.user.is_staff = False
+        self.assertFalse(should_profile(request))
+        with override_settings(LINTER_PROFILE=None):
+            request.user.is_staff = True
+            self.assertFalse(should_profile(request))
+
+    def test_ring_buffer(self):
+        """Profiles are recorded with stats and only the newest are kept"""
+        path = self.save('<# <Content Select="//Foo" > #>')
+        for _ in range(3):
+            res = lint_path(path, profile=True, name='mine.docx')
+        self.assertEqual(res['errors'][0]['error'], "Missing self-closing tag />")
+
+        profiles = slowest(10)
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(profiles[0]['name'], 'mine.docx')
+        self.assertEqual(profiles[0]['errors'], 1)
+        self.assertIn('open', profiles[0]['stages'])
+        self.assertTrue(profile_path(profiles[0]['id']))
+        self.assertIsNone(profile_path('../../etc/passwd'))
+
+    def test_profiles_page(self):
+        lint_path(self.save('Hello'), profile=True)
+        request = RequestFactory().get('/profiles/')
+        request.user = Staff()
+        response = views.profiles(request)
+        self.assertContains(response, 'template.docx')
+        self.assertContains(response, '.prof</a>')
+
+    def test_profiles_page_disabled(self):
+        request = RequestFactory().get('/profiles/')
+        request.user = Staff()
+        with override_settings(LINTER_PROFILE=None), self.assertRaises(Http404):
+            views.profiles(request)
+
+
+class ConditionalRegionTests(SimpleTestCase):
+    def test_outline(self):
+        """Matched paragraph-level conditionals become a nested region tree"""
+        paras = [
+            '<# <Conditional Select="//A" Match="" /> #>',  # 0
+            'Hello',
+            '<# <Conditional Select="//B" Match="" /> #>',  # 2
+            'Nested',
+            '<# <EndConditional /> #>',                     # 4
+            '<# <EndConditional /> #>',                     # 5
+            'Between',
+            '<# <Conditional Select="//C" Match="" /> #>',  # 7
+            '<# <Content Select="//Foo" > #>',
+            '<# <EndConditional /> #>',                     # 9
+            '<# <Conditional Select="//D" Match="" /> #>',  # unmatched
+        ]
+        _, regions = lint(ms_wordify('\n'.join(paras)), return_regions=True)
+        self.assertEqual(
+            [(row['start'], row['end'], row['depth']) for row in regions.outline()],
+            [(0, 5, 0), (2, 4, 1), (7, 9, 0)],
+        )
+        self.assertEqual([region.start for region in regions.enclosing(3)], [0, 2])
+        self.assertEqual([region.start for region in regions.enclosing(5)], [0])
+        self.assertEqual(regions.enclosing(6), [])
+        self.assertIsNone(regions.innermost(10))
+
+        report = build_report(ms_wordify('\n'.join(paras)))
+        self.assertEqual([(error['paragraph'], error['conditional']) for error in report['errors']], [(8, 7), (10, None)])
+
+    def test_end_before_start(self):
+        """An EndConditional before its Conditional doesn't make a backwards region"""
+        paras = [
+            '<# <EndConditional /> #>',
+            'Hello',
+            '<# <Conditional Select="//A" Match="" /> #>',
+        ]
+        _, regions = lint(ms_wordify('\n'.join(paras)), return_regions=True)
+        self.assertEqual(regions.outline(), [])
+        self.assertIsNone(regions.innermost(1))
+
+    def test_enclosing_matches_brute_force(self):
+        """innermost() agrees with a linear scan on a mix of deep and wide nesting"""
+        regions = [ConditionalRegion(i, 400 - i, '') for i in range(0, 150)]
+        regions += [ConditionalRegion(200 + 3 * i, 201 + 3 * i, '') for i in range(50) if 201 + 3 * i < 250]
+        index = RegionIndex(regions)
+        for paragraph in range(0, 402):
+            containing = [region for region in regions if region.contains(paragraph)]
+            expected = max(containing, key=lambda region: region.start) if containing else None
+            self.assertIs(index.innermost(paragraph), expected)
+
+    def test_deeply_nested(self):
+        """Thousands of nested conditionals lint and render without recursion"""
+        depth = 3000
+        paras = ['<# <Conditional Test="true" /> #>'] * depth + ['Hello'] + ['<# <EndConditional /> #>'] * depth
+        report = build_report(ms_wordify('\n'.join(paras)))
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(len(report['outline']), depth)
+        self.assertEqual(report['outline'][-1]['depth'], depth - 1)
+        html = ''.join(outline_html(report['outline']))
+        self.assertEqual(html.count('Paragraphs #'), depth)
+        self.assertEqual(html.count('<details'), MAX_OUTLINE_NESTING)
+        self.assertEqual(html.count('</details>'), MAX_OUTLINE_NESTING)
+        # The real DOM depth stays capped, however deep the conditionals go
+        nesting = deepest = 0
+        for tag in re.findall(r'</?(?:details|div)\b', html):
+            nesting += -1 if tag.startswith('</') else 1
+            deepest = max(deepest, nesting)
+        self.assertEqual(nesting, 0)
+        self.assertLessEqual(deepest, 2 * MAX_OUTLINE_NESTING + 1)
+        self.assertIn('level 3000', html)
+
+
+class AnnotateTests(TempDirMixin, SimpleTestCase):
+    def annotate(self, src, dest):
+        return lint_path(src, annotate_to=dest)
+
+    def test_annotate(self):
+        """Each error gets a comment anchored on its paragraph and other parts are copied raw"""
+        src = self.tmpdir + '/template.docx'
+        dest = self.tmpdir + '/annotated.docx'
+        paras = ['Hello', '<# <Content Select="//Foo" > #>', '<# <Bad /> #> <# <Content /> #>']
+        ms_wordify('\n'.join(paras), ul_paragraphs=[1]).save(src)
+        report = self.annotate(src, dest)
+        self.assertEqual(len(report['errors']), 3)
+
+        with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dest) as zout:
+            self.assertIsNone(zout.testzip())
+            rewritten = {'word/document.xml', 'word/_rels/document.xml.rels', '[Content_Types].xml', 'word/comments.xml'}
+            for info in zin.infolist():
+                if info.filename not in rewritten:
+                    copied = zout.getinfo(info.filename)
+                    self.assertEqual((copied.CRC, copied.compress_size, copied.compress_type), (info.CRC, info.compress_size, info.compress_type))
+            self.assertIn(COMMENTS_CONTENT_TYPE.encode(), zout.read('[Content_Types].xml'))
+            self.assertIn(COMMENTS_REL.encode(), zout.read('word/_rels/document.xml.rels'))
+            comments = etree.fromstring(zout.read('word/comments.xml'))
+            body = etree.fromstring(zout.read('word/document.xml')).find(f'{{{W}}}body')
+
+        texts = [''.join(comment.itertext()) for comment in comments]
+        self.assertEqual(texts[0], 'Missing self-closing tag />' + paras[1])
+        paragraphs = body.findall(f'{{{W}}}p')
+        self.assertEqual(len(paragraphs[0].findall(f'{{{W}}}commentRangeStart')), 0)
+        self.assertEqual(len(paragraphs[1].findall(f'{{{W}}}commentRangeStart')), 1)
+        self.assertEqual(len(paragraphs[2].findall(f'{{{W}}}r/{{{W}}}commentReference')), 2)
+        # pPr has to stay first
+        self.assertEqual(paragraphs[1][0].tag, f'{{{W}}}pPr')
+
+        # The annotated copy is still a valid document that lints the same
+        self.assertEqual(lint_path_errors(dest), lint_path_errors(src))
+
+    def test_annotate_existing_comments(self):
+        """Annotating a document that already has comments adds to them with fresh ids"""
+        src = self.tmpdir + '/template.docx'
+        once = self.tmpdir + '/once.docx'
+        twice = self.tmpdir + '/twice.docx'
+        ms_wordify('<# <Bad /> #>').save(src)
+        self.annotate(src, once)
+        self.annotate(once, twice)
+        with zipfile.ZipFile(twice) as zin:
+            comments = etree.fromstring(zin.read('word/comments.xml'))
+            self.assertEqual(zin.read('[Content_Types].xml').count(b'comments+xml'), 1)
+        self.assertEqual([comment.get(f'{{{W}}}id') for comment in comments], ['0', '1'])
+
+    def test_annotate_renamed_comments(self):
+        """An existing comments part is found through its relationship, whatever it is called"""
+        src = self.tmpdir + '/template.docx'
+        once = self.tmpdir + '/once.docx'
+        renamed = self.tmpdir + '/renamed.docx'
+        twice = self.tmpdir + '/twice.docx'
+        ms_wordify('<# <Bad /> #>').save(src)
+        self.annotate(src, once)
+        with zipfile.ZipFile(once) as zin, zipfile.ZipFile(renamed, 'w') as zout:
+            for info in zin.infolist():
+                data = zin.read(info.filename)
+                if info.filename in ('word/_rels/document.xml.rels', '[Content_Types].xml'):
+                    data = data.replace(b'comments.xml', b'notes/review.xml')
+                zout.writestr(info.filename.replace('word/comments.xml', 'word/notes/review.xml'), data)
+        self.annotate(renamed, twice)
+        with zipfile.ZipFile(twice) as zin:
+            self.assertNotIn('word/comments.xml', zin.namelist())
+            comments = etree.fromstring(zin.read('word/notes/review.xml'))
+            self.assertEqual(zin.read('word/_rels/document.xml.rels').count(COMMENTS_REL.encode()), 1)
+            self.assertEqual(zin.read('[Content_Types].xml').count(b'comments+xml'), 1)
+        self.assertEqual([comment.get(f'{{{W}}}id') for comment in comments], ['0', '1'])
+
+    def test_annotate_view(self):
+        """Asking for an annotated copy downloads it instead of the report"""
+        with override_settings(UPLOAD_DIR=self.tmpdir):
+            response = self.client.post(reverse('linter:index'), {'file': docx_upload(ms_wordify('<# <Bad /> #>')), 'terms': 'on', 'annotate': 'on'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="template (checked).docx"')
+        annotated = Document(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(len(lint(annotated)), 1)
+
+def lint_path_errors(path):
+    return lint_path(path)['errors']
+
+
+class ThreadSafetyTests(SimpleTestCase):
+    def test_concurrent_lints(self):
+        """Many lints at once in threads give the same errors as linting one at a time"""
+
+        # Unique attribute values per document so tags miss the cache and really validate concurrently
+        inputs = [
+            '\n'.join([
+                f'<# <Content Select="//Foo{i}" /> #>',
+                f'<# <Content Select="//Foo{i}" Bogus="{i}" /> #>',
+                f'<# <BadTagType{i % 7} Select="//Foo" /> #>',
+                f'<# <Conditional Select="//Foo{i}" Test="{"][" * (i % 3)}" /> #>',
+                '<# <EndConditional /> #>',
+                f'<# <Content Select="//Foo{i}" > #>',
+            ])
+            for i in range(120)
+        ]
+
+        def run(input):
+            return serialize_errors(lint(ms_wordify(input)))
+
+        check_tag.cache_clear()
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            concurrent = list(pool.map(run, inputs))
+        check_tag.cache_clear()
+        serial = [run(input) for input in inputs]
+
+        self.assertEqual(concurrent, serial)
+        self.assertIn("Unrecognized tag type: 'BadTagType3'", [error['error'] for error in serial[3]])
+
+
+def save_as(document, path, extension):
+    """Save document to path with its main part relabelled as another format, e.g. a dotx template."""
+    content_type = next(content_type for content_type, format in MAIN_CONTENT_TYPES.items() if format == extension)
+    stream = io.BytesIO()
+    document.save(stream)
+    with zipfile.ZipFile(stream) as zin, zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            data = zin.read(info.filename)
+            if info.filename == '[Content_Types].xml':
+                data = data.replace(b'application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml', content_type.encode())
+            zout.writestr(info, data)
+
+def save_flat_opc(document, path):
+    """Save document to path as a Flat OPC package, the way Word's "Save as XML" does."""
+    stream = io.BytesIO()
+    document.save(stream)
+    package = etree.Element(f'{{{PKG}}}package', nsmap={'pkg': PKG})
+    with zipfile.ZipFile(stream) as zin:
+        content_types = etree.fromstring(zin.read('[Content_Types].xml'))
+        overrides = {override.get('PartName'): override.get('ContentType') for override in content_types if override.get('PartName')}
+        for name in zin.namelist():
+            if not name.endswith('.xml') or name == '[Content_Types].xml':
+                continue
+            part = etree.SubElement(package, f'{{{PKG}}}part', {f'{{{PKG}}}name': '/' + name, f'{{{PKG}}}contentType': overrides.get('/' + name, 'application/xml')})
+            etree.SubElement(part, f'{{{PKG}}}xmlData').append(etree.fromstring(zin.read(name)))
+    with open(path, 'wb') as f:
+        f.write(b'<?xml version="1.0" standalone="yes"?>\n<?mso-application progid="Word.Document"?>\n')
+        f.write(etree.tostring(package))
+
+
+class InputFormatTests(TempDirMixin, SimpleTestCase):
+    paras = ['Hello', '<# <Content Select="//Foo" > #>', '<# <Bad /> #>', '<# <SuppressListItem Select="//Foo" /> #>', 'Bye']
+
+    def setUp(self):
+        super().setUp()
+        self.document = ms_wordify('\n'.join(self.paras))
+        self.docx = self.tmpdir + '/template.docx'
+        self.document.save(self.docx)
+
+    def test_templates_and_macro_enabled(self):
+        """Templates and macro-enabled documents lint like .docx, whatever their extension"""
+        expected = lint_path(self.docx)
+        for extension in ['dotx', 'docm', 'dotm']:
+            path = f'{self.tmpdir}/template.bin'
+            save_as(self.document, path, extension)
+            report = lint_path(path)
+            self.assertEqual(report['format'], extension)
+            self.assertEqual(report['errors'], expected['errors'])
+
+    def test_flat_opc(self):
+        """Flat OPC is streamed paragraph by paragraph and lints the same as the .docx"""
+        path = self.tmpdir + '/template.xml'
+        save_flat_opc(self.document, path)
+        report = lint_path(path, annotate_to=self.tmpdir + '/annotated')
+        self.assertEqual(report['format'], 'xml')
+        self.assertEqual(report['errors'], lint_path(self.docx)['errors'])
+        self.assertEqual(len(report['errors']), 3)
+        # Not annotated
+        self.assertFalse(os.path.exists(self.tmpdir + '/annotated'))
+
+    def test_not_a_document(self):
+        """Anything else is a bad document, including XML that isn't a Flat OPC package"""
+        for content in [b'Hello', b'<?xml version="1.0"?><root/>', b'PK\x03\x04 truncated']:
+            with open(self.tmpdir + '/upload.docx', 'wb') as f:
+                f.write(content)
+            with self.assertRaises(BadDocument):
+                lint_path(self.tmpdir + '/upload.docx')
+
+    def test_upload_annotated_template(self):
+        """An annotated template is downloaded with its own extension and content type"""
+        path = self.tmpdir + '/template.dotx'
+        save_as(self.document, path, 'dotx')
+        with open(path, 'rb') as f, override_settings(UPLOAD_DIR=self.tmpdir):
+            response = self.client.post(reverse('linter:index'), {'file': f, 'terms': 'on', 'annotate': 'on'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="template (checked).dotx"')
+        self.assertEqual(response['Content-Type'], 'application/vnd.openxmlformats-officedocument.wordprocessingml.template')
+
+
+def tracked_paragraph(document, pieces):
+    """Add a paragraph of (change, text) runs, where change is 'ins', 'del' or None for plain text."""
+    p = document.add_paragraph()._p
+    for change_id, (change, text) in enumerate(pieces):
+        parent = p
+        if change:
+            parent = OxmlElement(f'w:{change}')
+            parent.set(qn('w:id'), str(change_id))
+            parent.set(qn('w:author'), 'Reviewer')
+            p.append(parent)
+        r = OxmlElement('w:r')
+        t = OxmlElement('w:delText' if change == 'del' else 'w:t')
+        t.text = text
+        r.append(t)
+        parent.append(r)
+
+
+class TrackedChangesTests(SimpleTestCase):
+    def lint(self, pieces, view='accepted'):
+        document = Document()
+        tracked_paragraph(document, pieces)
+        return serialize_errors(lint(document, view=view))
+
+    def test_views(self):
+        """Insertions only count once accepted and deletions only in the original"""
+        pieces = [(None, '<# <Content Select="//Foo"'), ('del', ' Bogus="1"'), ('ins', ' Optional="true"'), (None, ' /> #>')]
+        self.assertEqual(self.lint(pieces), [])
+        errors = self.lint(pieces, view='original')
+        self.assertEqual([error['error'] for error in errors], ['Invalid attributes'])
+        self.assertEqual(errors[0]['directive_string'], '<# <Content Select="//Foo" Bogus="1" /> #>')
+        self.assertTrue(errors[0]['tracked_change'])
+
+    def test_split_directive(self):
+        """A directive marker split across a tracked change is still found"""
+        errors = self.lint([(None, '<# <Content Select="//Foo" > #'), ('ins', '>'), (None, ' tail')])
+        self.assertEqual([error['error'] for error in errors], ['Missing self-closing tag />'])
+        self.assertTrue(errors[0]['tracked_change'])
+        # In the original the #> was never closed
+        errors = self.lint([(None, '<# <Content Select="//Foo" > #'), ('ins', '>'), (None, ' tail')], view='original')
+        self.assertEqual([error['error'] for error in errors], ['Unmatched #> or <# directive'])
+
+    def test_deletion_inside_directive(self):
+        """Hidden deleted text inside a directive is noted, but changes outside it aren't"""
+        errors = self.lint([(None, '<# <Bad Select="//Foo"'), ('del', ' Bogus="1"'), (None, ' /> #>'), ('ins', ' after')])
+        self.assertTrue(errors[0]['tracked_change'])
+        errors = self.lint([('ins', 'before '), (None, '<# <Bad Select="//Foo" /> #>'), ('del', ' after')])
+        self.assertFalse(errors[0]['tracked_change'])
+
+    def test_solo_tag_with_insertion(self):
+        """An inserted paragraph-level Conditional is matched like any other"""
+        document = Document()
+        tracked_paragraph(document, [('ins', '<# <Conditional Select="//Foo" Match="" /> #>')])
+        document.add_paragraph('Hello')
+        document.add_paragraph('<# <EndConditional /> #>')
+        self.assertEqual(lint(document), [])
+        self.assertEqual([error.error for _, error in lint(document, view='original')], ['Unmatched paragraph-level EndConditional tag'])
+
+
+class DaemonTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket_path = self.tmpdir + '/lint.sock'
+
+    def start_server(self):
+        server = LintServer(self.socket_path, workers=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+        self.addCleanup(stop)
+        return server
+
+    def test_protocol(self):
+        """Messages are length-prefixed JSON"""
+        left, right = socket.socketpair()
+        with left, right:
+            message = {'path': '/tmp/x.docx', 'options': {}}
+            send_message(left, message)
+            body = json.dumps(message).encode()
+            self.assertEqual(right.recv(4 + len(body)), len(body).to_bytes(4, 'big') + body)
+            send_message(left, {'status': 'ok', 'payload': ['é']})
+            self.assertEqual(recv_message(right), {'status': 'ok', 'payload': ['é']})
+
+    def test_lint(self):
+        """Lints through the daemon give the same report as in-process, on one connection"""
+        self.start_server()
+        client = LintClient(self.socket_path)
+        self.addCleanup(client.disconnect)
+        path = self.save('<# <Content Select="//Foo" > #>')
+        self.assertEqual(client.lint(path, view='original'), lint_path(path, view='original'))
+        sock = client.local.sock
+        self.assertEqual(client.lint(path)['errors'][0]['error'], "Missing self-closing tag />")
+        self.assertIs(client.local.sock, sock)
+
+        with open(path, 'w') as f:
+            f.write('not a document')
+        with self.assertRaises(BadDocument):
+            client.lint(path)
+
+    def test_fallback(self):
+        """Uploads are linted in-process when the daemon isn't running"""
+        config = {'socket_path': self.socket_path, 'connect_timeout': 0.5, 'timeout': 30}
+        with override_settings(LINTER_DAEMON=config, LINTER_SANDBOX=None), mock.patch.object(daemon, '_client', None):
+            report = lint_upload(self.save('<# <Bad /> #>'))
+        self.assertEqual(len(report['errors']), 1)
+
+    def test_busy(self):
+        """A lint that can't get a worker in time is turned away with a 503, not run late"""
+        server = self.start_server()
+        server.pool.queue_wait = 0.1
+        worker = server.pool.idle.get()
+        self.addCleanup(server.pool.idle.put, worker)
+        client = LintClient(self.socket_path)
+        self.addCleanup(client.disconnect)
+        with self.assertRaises(SandboxBusy):
+            client.lint(self.save('Hello'))
+
+        with mock.patch('springcm_tools.linter.views.lint_upload', side_effect=SandboxBusy('busy')), override_settings(UPLOAD_DIR=self.tmpdir):
+            response = self.client.post(reverse('linter:index'), {'file': docx_upload(ms_wordify('Hello')), 'terms': 'on'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '10')
+
+    def test_already_running(self):
+        """A second daemon won't take over the socket, but a dead one's socket is replaced"""
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        self.start_server()
+        with self.assertRaises(OSError):
+            LintServer(self.socket_path, workers=1)
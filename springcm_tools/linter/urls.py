@@ -4,4 +4,7 @@ from . import views
 app_name = 'linter'
 urlpatterns = [
     path('', views.index, name='index'),
+    path('admission/', views.admission_stats, name='admission_stats'),
+    path('profiles/', views.profiles, name='profiles'),
+    path('profiles/<str:profile_id>.prof', views.profile_download, name='profile_download'),
 ]
\ No newline at end of file
@@ -1,8 +1,14 @@
 from django.apps import apps
 
+from bisect import bisect_right
 from collections import defaultdict
+from functools import lru_cache
+import threading
+from time import perf_counter
 from lxml import etree as ET
-from docx import Document
+from docx.opc.part import PartFactory
+from docx.package import Package
+from docx.parts.document import DocumentPart
 from environ import Path
 
 LINK_TYPES = {
@@ -10,6 +16,94 @@ LINK_TYPES = {
 }
 LINK_TYPES.update({ v:k for k,v in LINK_TYPES.items() })
 
+# Main document part content types we lint, and the extension Word saves each with
+MAIN_CONTENT_TYPES = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml': 'docx',
+    'application/vnd.ms-word.document.macroEnabled.main+xml': 'docm',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml': 'dotx',
+    'application/vnd.ms-word.template.macroEnabledTemplate.main+xml': 'dotm',
+}
+# Word's single-file XML package ("Flat OPC")
+FLAT_OPC = 'xml'
+FLAT_OPC_NAMESPACE = b'http://schemas.microsoft.com/office/2006/xmlPackage'
+SNIFF_BYTES = 4096
+
+# python-docx only knows the .docx main part. Templates and macro-enabled
+# documents have the same structure, so load them as documents too.
+for content_type in MAIN_CONTENT_TYPES:
+    PartFactory.part_type_for.setdefault(content_type, DocumentPart)
+
+class BadDocument(Exception):
+    """The upload couldn't be opened as a Word document."""
+
+
+# The parsed schema document is shared, but each thread compiles its own
+# validator: a validator's error_log is per instance, so two threads
+# validating with one validator would read each other's errors.
+_local = threading.local()
+_compile_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def relaxng_document():
+    rng_filename = Path(apps.get_app_config('linter').path)("tags.rng")
+    return ET.parse(rng_filename)
+
+def relaxng_schema():
+    """The RelaxNG validator for the current thread."""
+    relaxng = getattr(_local, 'relaxng', None)
+    if relaxng is None:
+        with _compile_lock:
+            relaxng = _local.relaxng = ET.RelaxNG(relaxng_document())
+    return relaxng
+
+@lru_cache(maxsize=4096)
+def valid_xpath(xpath):
+    try:
+        ET.XPath(xpath)
+    except ET.XPathError:
+        return False
+    return True
+
+@lru_cache(maxsize=4096)
+def check_tag(tag_string):
+    """
+    Validate a tag's XML against the schema and its XPath attributes.
+    Returns (type, error, error_raw). Templates repeat the same tags a lot,
+    so results are cached; lru_cache is safe to share between threads.
+    """
+    # Parse the tag into an XML element
+    try:
+        elem = ET.fromstring(tag_string)
+    except ET.ParseError:
+        # Catch malformed XML
+        return None, "Malformed XML", None
+
+    relaxng = relaxng_schema()
+
+    if not relaxng(elem):
+        return (elem.tag,) + relaxng_error(relaxng.error_log)
+
+    if "Select" in elem.attrib and not valid_xpath(elem.attrib["Select"]):
+        return elem.tag, "Select attribute has invalid XPath", None
+
+    if "Test" in elem.attrib and not valid_xpath(elem.attrib["Test"]):
+        return elem.tag, "Test attribute must be valid XPath that returns true or false", None
+
+    return elem.tag, None, None
+
+def relaxng_error(error_log):
+    """(error, error_raw) for the last RelaxNG validation error."""
+    if error_log.last_error.type_name == "RELAXNG_ERR_ATTRVALID" or error_log.last_error.type_name == "RELAXNG_ERR_INVALIDATTR":
+        return "Invalid attributes", error_log.last_error.message
+    elif error_log.last_error.type_name == "RELAXNG_ERR_ELEMWRONG":
+        msg = error_log.last_error.message
+        return f"Unrecognized tag type: '{msg.split()[-2]}'", error_log.last_error.message
+    else:
+        return "Unknown error: " + error_log.last_error.type_name + " " + error_log.last_error.message, None
+
+def warm():
+    """Compile the schema up front, e.g. in the gunicorn master before workers fork."""
+    relaxng_schema()
 
 def find_all(string, substring):
     start = 0
@@ -20,11 +114,96 @@ def find_all(string, substring):
         yield start
         start += len(substring)
 
+# Tracked changes: which view shows the content of each kind of change
+ACCEPTED = 'accepted'
+ORIGINAL = 'original'
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+TRACKED_CHANGES = {
+    f'{{{W}}}ins': ACCEPTED,
+    f'{{{W}}}moveTo': ACCEPTED,
+    f'{{{W}}}del': ORIGINAL,
+    f'{{{W}}}moveFrom': ORIGINAL,
+}
+# Inline elements that wrap runs without changing their text
+RUN_CONTAINERS = {f'{{{W}}}{tag}' for tag in ('hyperlink', 'smartTag', 'sdt', 'sdtContent', 'customXml', 'fldSimple')}
+RUN = f'{{{W}}}r'
+# Run content that reads as text: w:t and w:delText carry their own, the rest are fixed
+RUN_TEXT = {
+    f'{{{W}}}t': None,
+    f'{{{W}}}delText': None,
+    f'{{{W}}}tab': '\t',
+    f'{{{W}}}br': '\n',
+    f'{{{W}}}cr': '\n',
+}
+
+def scan_runs(p, view=ACCEPTED):
+    """
+    Walk the runs of paragraph element p once and return (text, opens, closes, changes):
+    the paragraph's text as it reads in view (ACCEPTED or ORIGINAL), the positions of
+    its <# and #> directives, and a (start, end) span in the text for each tracked
+    change. Changes that view hides get an empty span where their text would be.
+    """
+    pieces = []
+    opens = []
+    closes = []
+    changes = []
+    length = 0
+    last = ''
+    # Frames of (children, visible, start of the tracked change the frame is for or None)
+    stack = [(iter(p), True, None)]
+    while stack:
+        children, visible, change_start = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if change_start is not None:
+                changes.append((change_start, length))
+            continue
+
+        tag = child.tag
+        if tag in TRACKED_CHANGES:
+            stack.append((iter(child), visible and TRACKED_CHANGES[tag] == view, length))
+        elif tag in RUN_CONTAINERS:
+            stack.append((iter(child), visible, None))
+        elif tag == RUN and visible:
+            for elem in child:
+                if elem.tag not in RUN_TEXT:
+                    continue
+                text = RUN_TEXT[elem.tag] or elem.text
+                if not text:
+                    continue
+                # A directive can be split across runs
+                pair = last + text[0]
+                if pair == '<#':
+                    opens.append(length - 1)
+                elif pair == '#>':
+                    closes.append(length - 1)
+                opens.extend(length + index for index in find_all(text, '<#'))
+                closes.extend(length + index for index in find_all(text, '#>'))
+                pieces.append(text)
+                length += len(text)
+                last = text[-1]
+    return ''.join(pieces), opens, closes, changes
+
+def spans_change(start, end, changes):
+    """Whether the directive at text[start:end + 1] overlaps any of changes."""
+    for change_start, change_end in changes:
+        if change_start == change_end:
+            # Hidden text, which lies inside the directive if it was removed from between its characters
+            if start < change_start <= end:
+                return True
+        elif change_start <= end and change_end > start:
+            return True
+    return False
+
 class MergeTag:
-    def __init__(self, start, end, paragraph):
+    def __init__(self, start, end, paragraph, text=None, changes=()):
         self.error = None
         self.error_raw = None
-        self.directive_string = paragraph.text[start:end + 1]
+        if text is None:
+            text = paragraph.text
+        self.directive_string = text[start:end + 1]
+        self.tracked_change = spans_change(start, end, changes)
         self.linked_tag = None
         self.type = None
 
@@ -44,40 +223,10 @@ class MergeTag:
             self.error = "Missing self-closing tag />"
             return
 
-        # Parse the tag into an XML element
-        try:
-            self.elem = ET.fromstring(self.tag_string)
-        except ET.ParseError: 
-            # Catch malformed XML
-            self.error = "Malformed XML"
-            return
-        
-        self.type = self.elem.tag
-
-        rng_filename = Path(apps.get_app_config('linter').path)("tags.rng")
-        relaxng_doc = ET.parse(rng_filename)
-        relaxng = ET.RelaxNG(relaxng_doc)
-
-        if not relaxng(self.elem):
-            self.extract_relaxng_validation_error(relaxng.error_log)
+        self.type, self.error, self.error_raw = check_tag(self.tag_string)
+        if self.error:
             return
 
-        if "Select" in self.elem.attrib:
-            xpath = self.elem.attrib["Select"]
-            try:
-                ET.XPath(xpath)
-            except ET.XPathError:
-                self.error = "Select attribute has invalid XPath"
-                return
-
-        if "Test" in self.elem.attrib:
-            xpath = self.elem.attrib["Test"]
-            try:
-                ET.XPath(xpath)
-            except ET.XPathError:
-                self.error = "Test attribute must be valid XPath that returns true or false"
-                return
-
         # SuppressListItem must appear in a list
         if self.type == "SuppressListItem":
             pPr = paragraph._p.get_or_add_pPr()
@@ -85,17 +234,6 @@ class MergeTag:
                 self.error = "SuppressListItem must appear in a bullet or ordered list item"
                 return
 
-    def extract_relaxng_validation_error(self, error_log):
-        if error_log.last_error.type_name == "RELAXNG_ERR_ATTRVALID" or error_log.last_error.type_name == "RELAXNG_ERR_INVALIDATTR":
-            self.error = "Invalid attributes"
-            self.error_raw = error_log.last_error.message
-        elif error_log.last_error.type_name == "RELAXNG_ERR_ELEMWRONG":
-            msg = error_log.last_error.message 
-            self.error = f"Unrecognized tag type: '{msg.split()[-2]}'"
-            self.error_raw = error_log.last_error.message
-        else:
-            self.error = "Unknown error: " + error_log.last_error.type_name + " " + error_log.last_error.message
-
     @classmethod
     def match_tags(cls, merge_tags, inline=True):
         link_stack = { k: [] for k in LINK_TYPES }
@@ -119,11 +257,106 @@ class MergeTag:
                 else:
                     tag.error = f'Unmatched paragraph-level {type} tag'
 
+class ConditionalRegion:
+    """Paragraphs from a paragraph-level Conditional through its matching EndConditional."""
+    def __init__(self, start, end, directive_string):
+        self.start = start
+        self.end = end
+        self.directive_string = directive_string
+        self.parent = None
+        self.depth = 0
+        self.children = []
+        # jumps[k] is the 2**k-th ancestor, for skipping up the tree in O(log depth)
+        self.jumps = []
+
+    def contains(self, paragraph_number):
+        return self.start <= paragraph_number <= self.end
+
+class RegionIndex:
+    """
+    Nested regions of matched paragraph-level conditionals, indexed by paragraph.
+
+    Matched pairs come off a stack, so regions never partially overlap: two
+    regions are either disjoint or one contains the other. That makes the
+    regions sorted by start a pre-order walk of the tree.
+    """
+    def __init__(self, regions):
+        self.regions = sorted(regions, key=lambda region: region.start)
+        self.starts = [region.start for region in self.regions]
+        self.roots = []
+
+        stack = []
+        for region in self.regions:
+            while stack and stack[-1].end < region.start:
+                stack.pop()
+            if stack:
+                region.parent = stack[-1]
+                region.depth = region.parent.depth + 1
+                region.parent.children.append(region)
+            else:
+                self.roots.append(region)
+            stack.append(region)
+
+            # Parents come first in pre-order, so their jump tables are already built
+            ancestor = region.parent
+            while ancestor:
+                region.jumps.append(ancestor)
+                jumps = ancestor.jumps
+                ancestor = jumps[len(region.jumps) - 1] if len(jumps) >= len(region.jumps) else None
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """Build the index from the paragraph-level tags of blocks, after they've been matched."""
+        paragraph_of = {id(block.merge_tags[0]): block.paragraph_number for block in blocks}
+        regions = []
+        for block in blocks:
+            tag = block.merge_tags[0]
+            if tag.type == "Conditional" and tag.linked_tag is not None:
+                end = paragraph_of[id(tag.linked_tag)]
+                # match_tags also pairs an EndConditional with a Conditional after it, which isn't a region
+                if end > block.paragraph_number:
+                    regions.append(ConditionalRegion(block.paragraph_number, end, tag.directive_string))
+        return cls(regions)
+
+    def innermost(self, paragraph_number):
+        """The innermost region containing paragraph_number, or None. O(log n)."""
+        # The region starting closest before the paragraph either contains it, or
+        # the innermost region that does is one of its ancestors. Ancestors' ends
+        # only grow going up, so find the first one that reaches the paragraph.
+        index = bisect_right(self.starts, paragraph_number) - 1
+        if index < 0:
+            return None
+        region = self.regions[index]
+        if region.contains(paragraph_number):
+            return region
+        for level in range(len(region.jumps) - 1, -1, -1):
+            if level < len(region.jumps) and not region.jumps[level].contains(paragraph_number):
+                region = region.jumps[level]
+        return region.parent
+
+    def enclosing(self, paragraph_number):
+        """All regions containing paragraph_number, outermost first. O(log n + k) for k results."""
+        region = self.innermost(paragraph_number)
+        regions = []
+        while region:
+            regions.append(region)
+            region = region.parent
+        return regions[::-1]
+
+    def outline(self):
+        """Pre-order rows of the region tree for rendering."""
+        return [
+            {'start': region.start, 'end': region.end, 'depth': region.depth, 'directive_string': region.directive_string}
+            for region in self.regions
+        ]
+
 class Paragraph:
-    def __init__(self, docx_paragraph, paragraph_number):
+    def __init__(self, docx_paragraph, paragraph_number, view=ACCEPTED):
         self.docx_paragraph = docx_paragraph
         self.paragraph_number = paragraph_number
+        self.view = view
         self.error = None
+        self.tracked_change = False
         self.solo_tag = False
         self.merge_tags = None
         self.needs_link = False
@@ -131,37 +364,38 @@ class Paragraph:
     def process(self):
         self.merge_tags = []
 
-        # Get positions of all opening and closing <# #> directives
-        open_directives = list(find_all(self.docx_paragraph.text, "<#"))
-        close_directives = list(find_all(self.docx_paragraph.text, "#>"))
+        # Get the text and the positions of all opening and closing <# #> directives in one pass over the runs
+        text, open_directives, close_directives, changes = scan_runs(self.docx_paragraph._p, self.view)
 
         # Test for paragraph-level errors
         # Don't parse merge tags if these are encountered.
         if len(open_directives) != len(close_directives):
             self.error = "Unmatched #> or <# directive"
+            # Can't tell which directive is unmatched, so note any change in the paragraph
+            self.tracked_change = bool(changes)
             return
 
         for index in range(len(open_directives) - 1):
             if open_directives[index + 1] < close_directives[index]:
                 self.error = "Nested #> or <# directives not allowed"
+                self.tracked_change = bool(changes)
                 return
 
         directive_pairs = list(zip(open_directives, close_directives))
         # Check if the tag is a paragraph-level tag, i.e., nothing else in it
         # Need to trim whitespace because it does not interfere with paragraph-level determination
-        trimmed_text = self.docx_paragraph.text.strip()
-        open_directive_trimmed = list(find_all(trimmed_text, "<#"))
-        close_directive_trimmed = list(find_all(trimmed_text, "#>"))
+        trimmed_text = text.strip()
+        leading_whitespace = len(text) - len(text.lstrip())
 
         if len(directive_pairs) != 0:
-            if open_directive_trimmed[0] == 0 and close_directive_trimmed[0] + 2 == len(trimmed_text):
+            if open_directives[0] == leading_whitespace and close_directives[0] + 2 - leading_whitespace == len(trimmed_text):
                 self.solo_tag = True
 
         # Parse each directive into a MergeTag object
         # (cant easily have subclasses of MergeTag bc need to parse the tag before I know what type it is)
         for start, end in directive_pairs:
             end = end + 1 # this is because we want the position of the > character, not the # character in the #>
-            self.merge_tags.append(MergeTag(start, end, self.docx_paragraph))
+            self.merge_tags.append(MergeTag(start, end, self.docx_paragraph, text, changes))
 
         # If there are any tag errors, don't bother processing links.
         # Because it gives misleading unmatched links errors.
@@ -182,19 +416,121 @@ class Paragraph:
         else:
             return [(self.paragraph_number, tag) for tag in self.merge_tags if tag.error]
 
-def lint(document):
+def lint(document, stats=None, return_regions=False, view=ACCEPTED):
+    """
+    Lint document as it reads with its tracked changes accepted, or with view=ORIGINAL,
+    as it read before them. If a stats dict is passed, fill it with document counts and
+    time per stage. With return_regions, return (doc_errors, RegionIndex of paragraph-level conditionals).
+    """
     blocks = []
     doc_errors = []
 
+    if stats is not None:
+        start = perf_counter()
+
     for index, docx_paragraph in enumerate(document.paragraphs):
-        block = Paragraph(docx_paragraph, index)
+        block = Paragraph(docx_paragraph, index, view)
         block.process()
         blocks.append(block)
 
-    solo_tags_to_match = [block.merge_tags[0] for block in blocks if block.needs_link]
-    MergeTag.match_tags(solo_tags_to_match, inline=False)
+    if stats is not None:
+        processed = perf_counter()
+
+    solo_blocks = [block for block in blocks if block.needs_link]
+    MergeTag.match_tags([block.merge_tags[0] for block in solo_blocks], inline=False)
+
+    if stats is not None:
+        matched = perf_counter()
 
     for block in blocks:
         doc_errors.extend(block.errors())
 
-    return doc_errors
\ No newline at end of file
+    if stats is not None:
+        stats['paragraphs'] = len(blocks)
+        stats['tags'] = sum(len(block.merge_tags) for block in blocks)
+        stats['errors'] = len(doc_errors)
+        stats.setdefault('stages', {}).update({
+            'process': processed - start,
+            'match': matched - processed,
+            'collect': perf_counter() - matched,
+        })
+
+    if return_regions:
+        return doc_errors, RegionIndex.from_blocks(solo_blocks)
+    return doc_errors
+
+def serialize_errors(doc_errors):
+    """Flatten lint() output into plain dicts so the report doesn't hold onto the document."""
+    return [
+        {
+            'paragraph': paragraph_number,
+            'error': obj.error,
+            'directive_string': getattr(obj, 'directive_string', ''),
+            'tracked_change': obj.tracked_change,
+        }
+        for paragraph_number, obj in doc_errors
+    ]
+
+def sniff(path):
+    """Detect the file type from its first bytes: 'zip' for an OPC package (.docx and friends) or FLAT_OPC."""
+    with open(path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    if head.startswith(b'PK\x03\x04'):
+        return 'zip'
+    if head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<') and FLAT_OPC_NAMESPACE in head:
+        return FLAT_OPC
+    raise BadDocument('Not a Word document or Flat OPC file')
+
+def open_document(path):
+    """
+    Open the Word document, template or Flat OPC file at path.
+    Raises BadDocument if it can't be opened.
+    """
+    try:
+        if sniff(path) == FLAT_OPC:
+            from .flatopc import FlatOpcDocument
+            return FlatOpcDocument(path)
+        document_part = Package.open(path).main_document_part
+        if document_part.content_type not in MAIN_CONTENT_TYPES:
+            raise BadDocument(f'Not a Word document, content type is {document_part.content_type}')
+        return document_part.document
+    except (BadDocument, MemoryError):
+        raise
+    except Exception as e:
+        raise BadDocument(str(e))
+
+def document_format(document):
+    """The extension for document's format: docx, docm, dotx, dotm or FLAT_OPC."""
+    if getattr(document, 'format', None) == FLAT_OPC:
+        return FLAT_OPC
+    return MAIN_CONTENT_TYPES[document.part.content_type]
+
+def build_report(document, stats=None, view=ACCEPTED):
+    """Lint document into a plain report: serialized errors and the outline of its conditionals."""
+    doc_errors, regions = lint(document, stats, return_regions=True, view=view)
+    errors = serialize_errors(doc_errors)
+    for error in errors:
+        region = regions.innermost(error['paragraph'])
+        error['conditional'] = region.start if region else None
+    return {'errors': errors, 'outline': regions.outline(), 'format': document_format(document), 'view': view}
+
+def lint_path(path, profile=False, name=None, annotate_to=None, view=ACCEPTED):
+    """
+    Lint the document at path into a report (see build_report) as it reads in view (ACCEPTED or ORIGINAL).
+    Raises BadDocument if it can't be opened.
+    With profile, the lint is run under cProfile and recorded (see profiling.py).
+    With annotate_to, also write a copy of the document there with a Word comment at each error.
+    Flat OPC files are only ever streamed, so they aren't annotated.
+    """
+    if profile:
+        from .profiling import profile_lint_path
+        report, document = profile_lint_path(path, name, view)
+    else:
+        document = open_document(path)
+        report = build_report(document, view=view)
+
+    if annotate_to and report['format'] != FLAT_OPC:
+        from .annotate import annotate
+        # Reuse the document.xml tree python-docx already parsed
+        annotate(path, annotate_to, report['errors'], document.element)
+    return report
@@ -1,41 +1,180 @@
+from collections import Counter
 from datetime import datetime as dt
 import os
 
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
-from django.http import HttpResponse, Http404
+from django.http import FileResponse, HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.conf import settings
+from django.template.loader import get_template, render_to_string
+from django.utils.html import format_html
 
+from .admission import admission_control, busy_response, get_controller
 from .forms import UploadFileForm
-from .utils import lint, Document
+
+# The report page is rendered once with these markers where the error list and
+# the conditional outline go, and those are streamed in chunks in their place.
+ERRORS_MARKER = '<!-- errors -->'
+OUTLINE_MARKER = '<!-- outline -->'
+ERRORS_CHUNK_SIZE = 250
+# Retry-After for uploads the lint daemon had no free worker for
+BUSY_RETRY_AFTER = 10
+# Outline levels rendered as nested <details> (two elements each); deeper rows are flat, indented up to MAX_FLAT_INDENT rem
+MAX_OUTLINE_NESTING = 40
+MAX_FLAT_INDENT = 20
+
+# Content types for annotated copies, by format (see utils.MAIN_CONTENT_TYPES)
+DOWNLOAD_CONTENT_TYPES = {
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'docm': 'application/vnd.ms-word.document.macroEnabled.12',
+    'dotx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.template',
+    'dotm': 'application/vnd.ms-word.template.macroEnabled.12',
+}
 
 def index(request):
     if request.method == "POST":
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
-            return index_uploaded(request)
+            return index_uploaded(request, annotate=form.cleaned_data['annotate'], view=form.cleaned_data['view'] or 'accepted')
     else:
         form = UploadFileForm()
+        if 'profile' in request.GET:
+            # Keep the flag on the upload so staff can profile a specific template
+            form.helper.form_action = request.get_full_path()
 
     return render(request, 'linter/index.html', {'form': form})
 
-def index_uploaded(request):
+@admission_control
+def index_uploaded(request, annotate=False, view='accepted'):
     uploaded_file = request.FILES['file']
     os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
     now_str = dt.now().strftime('%Y%m%d%H%M%S')
     filename = now_str + '_' + uploaded_file.name
-    with open(settings.UPLOAD_DIR + '/' + filename, 'wb') as f:
+    path = settings.UPLOAD_DIR + '/' + filename
+    with open(path, 'wb') as f:
         for chunk in uploaded_file.chunks():
             f.write(chunk)
 
-    if uploaded_file.name[-5:] != '.docx':
-        return render(request, 'linter/bad_upload.html')
+    # lxml and python-docx are only needed once there's something to lint,
+    # so keep them off the import path of the plain index page.
+    # The format is sniffed from the content when the file is opened, so the extension isn't checked here.
+    from .utils import BadDocument, FLAT_OPC
+    from .sandbox import DocumentTooComplex, SandboxBusy
+    from .profiling import should_profile
 
+    annotated_path = path + '.annotated' if annotate else None
     try:
-        document = Document(uploaded_file)
-    except Exception:
+        report = lint_upload(path, profile=should_profile(request), name=uploaded_file.name, annotate_to=annotated_path, view=view)
+    except BadDocument:
         return render(request, 'linter/bad_upload.html')
+    except DocumentTooComplex:
+        return render(request, 'linter/too_complex.html')
+    except SandboxBusy:
+        return busy_response(request, 'workers', BUSY_RETRY_AFTER)
+
+    # Flat OPC files aren't annotated, so they get the report instead
+    if annotated_path and report['format'] != FLAT_OPC:
+        name, _ = os.path.splitext(uploaded_file.name)
+        return FileResponse(
+            open(annotated_path, 'rb'), as_attachment=True,
+            filename=f"{name} (checked).{report['format']}",
+            content_type=DOWNLOAD_CONTENT_TYPES[report['format']],
+        )
+    return stream_report(request, report, uploaded_file.name)
+
+@staff_member_required
+def admission_stats(request):
+    if not settings.LINTER_ADMISSION:
+        raise Http404
+    return JsonResponse(get_controller().stats())
+
+@staff_member_required
+def profiles(request):
+    if not settings.LINTER_PROFILE:
+        raise Http404
+    from .profiling import slowest
+    return render(request, 'linter/profiles.html', {'profiles': slowest(settings.LINTER_PROFILE['show'])})
+
+@staff_member_required
+def profile_download(request, profile_id):
+    if not settings.LINTER_PROFILE:
+        raise Http404
+    from .profiling import profile_path
+    path = profile_path(profile_id)
+    if not path:
+        raise Http404
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=profile_id + '.prof')
+
+def lint_upload(path, **options):
+    if settings.LINTER_DAEMON:
+        from .daemon import DaemonUnavailable, get_client
+        try:
+            return get_client().lint(path, **options)
+        except DaemonUnavailable:
+            # Not running, so lint here as if there were no daemon
+            pass
+
+    if settings.LINTER_SANDBOX:
+        from .sandbox import get_pool
+        return get_pool().lint(path, **options)
+
+    from .utils import lint_path
+    return lint_path(path, **options)
+
+def stream_report(request, report, orig_filename):
+    doc_errors = report['errors']
+    context = {
+        'num_errors': len(doc_errors),
+        'error_counts': Counter(error['error'] for error in doc_errors).most_common(),
+        'num_conditionals': len(report['outline']),
+        'orig_filename': orig_filename,
+        'view': report['view'],
+    }
+    page = render_to_string('linter/index_uploaded.html', context, request)
+    # Split on each marker separately: a clean report has no error list, and a report
+    # without conditionals has no outline.
+    before_outline, _, tail = page.partition(OUTLINE_MARKER)
+    head, _, middle = before_outline.partition(ERRORS_MARKER)
+
+    def stream():
+        # Summary first, so the browser can paint it while the list is still being rendered.
+        yield head
+        chunk_template = get_template('linter/error_list_chunk.html')
+        for start in range(0, len(doc_errors), ERRORS_CHUNK_SIZE):
+            yield chunk_template.render({'errors': doc_errors[start:start + ERRORS_CHUNK_SIZE]})
+        yield middle
+        yield ''.join(outline_html(report['outline']))
+        yield tail
 
-    doc_errors = lint(document)
-    num_errors = len(doc_errors)
+    return StreamingHttpResponse(stream())
 
-    return render(request, 'linter/index_uploaded.html', { 'doc_errors': doc_errors, 'num_errors': num_errors, 'orig_filename': uploaded_file.name })
\ No newline at end of file
+def outline_html(outline):
+    """
+    Render the pre-order outline rows as nested <details>, without recursion
+    so templates with thousands of nested conditionals are fine. Browsers stop
+    building or laying out the DOM a few hundred elements deep, so past
+    MAX_OUTLINE_NESTING levels rows are flat and indented by their depth.
+    """
+    depth = 0
+    for index, region in enumerate(outline):
+        while depth > min(region['depth'], MAX_OUTLINE_NESTING):
+            yield '</div></details>'
+            depth -= 1
+        has_children = index + 1 < len(outline) and outline[index + 1]['depth'] > region['depth']
+        label = format_html(
+            'Paragraphs #{}&ndash;#{} <code>{}</code>',
+            region['start'], region['end'], region['directive_string'],
+        )
+        if region['depth'] >= MAX_OUTLINE_NESTING:
+            yield format_html(
+                '<div style="padding-left:{}rem">{} <small class="text-muted">level {}</small></div>',
+                min(region['depth'] - MAX_OUTLINE_NESTING, MAX_FLAT_INDENT), label, region['depth'] + 1,
+            )
+        elif has_children:
+            yield format_html('<details{}><summary>{}</summary><div class="ml-3">', ' open' if region['depth'] == 0 else '', label)
+            depth += 1
+        else:
+            yield format_html('<div>{}</div>', label)
+    while depth:
+        yield '</div></details>'
+        depth -= 1